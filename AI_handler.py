@@ -1,45 +1,287 @@
-
+import asyncio
+import hashlib
+import itertools
+import json
 import os
+import re
 import traceback
-from openai import OpenAI
+from typing import Any, Awaitable, Callable, Dict
+
+import httpx
+from openai import AsyncOpenAI
+
+import local_store
+import metrics
 
 # --- LM-Studio Client Initialization ---
 
 # 環境変数からLM-StudioのベースURLを取得
 LM_STUDIO_BASE_URL = os.getenv("LM_STUDIO_BASE_URL", "http://localhost:1234/v1")
 LM_STUDIO_MODEL= os.getenv("LM_STUDIO_MODEL", "mlx-community/gemma-3-1b-it-qat")
+# ローカルのLM-Studioに同時に送るリクエスト数と、1リクエストあたりのタイムアウト(秒)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "1"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "600"))
+
+# 1回のプロンプトに含める本文量の上限(推定トークン数)。これを超えるページは分割して要約してから統合する
+LLM_CHUNK_TOKEN_BUDGET = int(os.getenv("LLM_CHUNK_TOKEN_BUDGET", "3000"))
+
+# LLMの応答キャッシュに保存する件数の上限
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+
+# 自己評価のスコア(0〜100)がこの値を下回った場合のみ、要約を再生成する
+LLM_EVALUATION_THRESHOLD = int(os.getenv("LLM_EVALUATION_THRESHOLD", "70"))
+
+# プロンプトのテンプレートを変更した場合は、この値を上げて古いキャッシュを使わないようにする
+PROMPT_VERSION = "2"
+
+# 自己評価の基準 (JSONのキー → 表示名)
+EVALUATION_CRITERIA = {
+    "coverage": "網羅性",
+    "accuracy": "正確性",
+    "neutrality": "中立性",
+    "clarity": "明瞭性",
+}
+
+# 生成の途中経過を受け取るコールバック (現在のステップの説明, 生成途中の本文)
+ProgressCallback = Callable[[str, str], None]
+
+# 自己評価の結果ごとの件数 (合格 / 再生成 / 解析できず一次生成を採用 / 評価自体に失敗)
+_evaluation_stats = {"passed": 0, "regenerated": 0, "unparsed": 0, "failed": 0}
+
+# リクエストの優先度 (小さいほど先に処理される)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
 
 # LM-Studioのクライアントを初期化 (APIキーは "not-needed" など適当な文字列でOK)
 try:
-    client = OpenAI(base_url=LM_STUDIO_BASE_URL, api_key="not-needed")
+    client = AsyncOpenAI(
+        base_url=LM_STUDIO_BASE_URL,
+        api_key="not-needed",
+        timeout=LLM_REQUEST_TIMEOUT,
+        # 接続はプールして使い回す
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY),
+            event_hooks=metrics.httpx_event_hooks("LLM"),
+        ),
+    )
 except Exception as e:
     print(f"AIハンドラの初期化中にエラーが発生しました: {e}")
     client = None
 
-def _call_llm(prompt: str, temperature: float = 0.7) -> str | None:
-    """LLMにリクエストを送信し、テキスト応答を取得する内部関数"""
+# LLMへのリクエストを優先度順に処理するキューとワーカー
+_request_queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+_request_sequence = itertools.count()
+_workers: list[asyncio.Task] = []
+_in_flight = 0
+
+
+async def _worker():
+    """キューから優先度の高い順にリクエストを取り出して実行する"""
+    global _in_flight
+    while True:
+        _, _, request_fn, future = await _request_queue.get()
+        if future.done():
+            # 待っている間に呼び出し元がキャンセルした
+            _request_queue.task_done()
+            continue
+        _in_flight += 1
+        task = asyncio.ensure_future(request_fn())
+        # 呼び出し元がキャンセルしたら、実行中のリクエストも止める
+        future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+        await asyncio.wait([task])
+        _in_flight -= 1
+        _request_queue.task_done()
+        if future.done():
+            continue
+        if task.cancelled():
+            future.cancel()
+        elif task.exception():
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+async def _submit(request_fn: Callable[[], Awaitable[Any]], priority: int) -> Any:
+    """リクエストをキューに積み、順番が来て実行されるまで待つ"""
+    if len(_workers) < LLM_MAX_CONCURRENCY:
+        _workers.extend(asyncio.create_task(_worker()) for _ in range(LLM_MAX_CONCURRENCY - len(_workers)))
+    future = asyncio.get_running_loop().create_future()
+    await _request_queue.put((priority, next(_request_sequence), request_fn, future))
+    return await future
+
+
+def get_queue_depth() -> int:
+    """実行待ち・実行中のリクエスト数を返す"""
+    return _request_queue.qsize() + _in_flight
+
+
+def _cache_key(kind: str, text: str, temperature: float | None = None) -> str:
+    """モデル名・temperature・プロンプトのバージョンと本文から、キャッシュのキーを計算する"""
+    source = json.dumps([kind, LM_STUDIO_MODEL, temperature, PROMPT_VERSION, text], ensure_ascii=False)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+async def _call_llm(
+    prompt: str,
+    temperature: float = 0.7,
+    priority: int = PRIORITY_BACKGROUND,
+    on_token: Callable[[str], None] | None = None,
+) -> str | None:
+    """
+    LLMにリクエストを送信し、テキスト応答を取得する内部関数。同じプロンプトへの応答はキャッシュから返す。
+    on_tokenを指定した場合はストリーミングで受信し、受信するたびにそれまでの応答全体を渡して呼び出す
+    """
+    cache_key = _cache_key("prompt", prompt, temperature)
+    cached = local_store.get_llm_cache(cache_key)
+    if cached is not None:
+        metrics.inc("llm_cache_hits_total")
+        if on_token:
+            on_token(cached)
+        return cached
+
     if not client:
         print("AIクライアントが初期化されていません。")
         return None
-    try:
+
+    async def request() -> str | None:
         # シンプルなuser-assistant形式の会話
         messages = [
             {"role": "user", "content": prompt}
         ]
-        
-        response = client.chat.completions.create(
-            model=LM_STUDIO_MODEL,  # LM-Studioでロードしているモデルに依存
-            messages=messages,
-            temperature=temperature,
-        )
-        return response.choices[0].message.content
+
+        if on_token:
+            with metrics.request_timer("LLM", "chat.completions.stream"):
+                stream = await client.chat.completions.create(
+                    model=LM_STUDIO_MODEL,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                )
+                content = ""
+                chunk_count = 0
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        content += delta
+                        chunk_count += 1
+                        on_token(content)
+            # ストリーミングでは使用量が返らないことがあるため、入力は推定値、出力は受信したチャンク数で数える
+            metrics.inc("llm_tokens_total", _estimate_tokens(prompt), kind="prompt")
+            metrics.inc("llm_tokens_total", chunk_count, kind="completion")
+            return content
+
+        with metrics.request_timer("LLM", "chat.completions"):
+            response = await client.chat.completions.create(
+                model=LM_STUDIO_MODEL,  # LM-Studioでロードしているモデルに依存
+                messages=messages,
+                temperature=temperature,
+            )
+        content = response.choices[0].message.content
+        usage = response.usage
+        metrics.inc("llm_tokens_total", usage.prompt_tokens if usage else _estimate_tokens(prompt), kind="prompt")
+        metrics.inc("llm_tokens_total", usage.completion_tokens if usage else _estimate_tokens(content or ""), kind="completion")
+        return content
+
+    try:
+        result = await _submit(request, priority)
+    except asyncio.CancelledError:
+        raise
     except Exception:
         print("LLMへのリクエスト中に予期せぬエラーが発生しました:")
         print(traceback.format_exc())
         return None
 
-def _build_generation_prompt(text_content: str, feedback: str = None) -> str:
-    """ナレッジ生成用のプロンプトを構築する"""
+    if result:
+        local_store.set_llm_cache(cache_key, result, LLM_CACHE_MAX_ENTRIES)
+    return result
+
+
+def _estimate_tokens(text: str) -> int:
+    """プロンプトのトークン数を概算する (日本語などの非ASCII文字は1文字1トークン、ASCIIは4文字1トークン)"""
+    ascii_count = sum(1 for c in text if c.isascii())
+    return (len(text) - ascii_count) + ascii_count // 4 + 1
+
+
+def _split_into_chunks(text_content: str, token_budget: int | None = None) -> list[str]:
+    """本文をブロック(行)の境界で、1チャンクあたりtoken_budget以内になるよう分割する"""
+    token_budget = token_budget or LLM_CHUNK_TOKEN_BUDGET
+    chunks = []
+    current = []
+    current_tokens = 0
+    for line in text_content.split("\n"):
+        line_tokens = _estimate_tokens(line)
+        # 1ブロックだけで予算を超える場合は、文字数で強制的に区切る
+        while line_tokens > token_budget:
+            cut = max(1, len(line) * token_budget // line_tokens)
+            if current:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            chunks.append(line[:cut])
+            line = line[cut:]
+            line_tokens = _estimate_tokens(line)
+        if current and current_tokens + line_tokens > token_budget:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _build_chunk_summary_prompt(chunk: str, index: int, total: int) -> str:
+    """長い会話ログの一部分を要約するプロンプトを構築する (map段階)"""
+    prompt = f"""# Role
+あなたは、プロの議事録作成アシスタントです。
+
+# Context
+以下は、長いDiscordの会話ログを{total}個に分割したうちの{index}番目の部分です。後で他の部分の要約と統合するため、この部分だけを要約してください。
+
+# Data
+---
+{chunk}
+---
+
+# Instruction
+この部分の会話について、以下を箇条書きで簡潔にまとめてください。該当するものが無い項目は省略して構いません。
+- 話題と主要な意見（誰の意見かが分かるように）
+- 反対意見や懸念事項
+- 決まったこと
+- 発生したタスク（担当者・期限が分かれば併記）
+"""
+    return prompt
+
+
+async def _condense_long_text(text_content: str, priority: int) -> str | None:
+    """予算を超える本文を、チャンクごとの並行要約と段階的な統合で予算内の要約メモに縮める (map-reduce)"""
+    partials = [text_content]
+    round_number = 1
+    while _estimate_tokens("\n".join(partials)) > LLM_CHUNK_TOKEN_BUDGET:
+        chunks = _split_into_chunks("\n".join(partials))
+        print(f"  - 分割要約 (第{round_number}段階): {len(chunks)}個のチャンクを並行して要約中...")
+        summaries = await asyncio.gather(*(
+            _call_llm(_build_chunk_summary_prompt(chunk, i, len(chunks)), temperature=0.3, priority=priority)
+            for i, chunk in enumerate(chunks, start=1)
+        ))
+        if not all(summaries):
+            print("  - 分割要約に失敗しました。")
+            return None
+        if len(summaries) >= len(partials) and round_number > 1:
+            # 要約しても縮まらない場合は、これ以上繰り返さない
+            partials = summaries
+            break
+        partials = summaries
+        round_number += 1
+    return "\n\n".join(partials)
+
+
+def _build_generation_prompt(
+    text_content: str, feedback: str = None, is_condensed: bool = False, previous_summary: str | None = None
+) -> str:
+    """
+    ナレッジ生成用のプロンプトを構築する。is_condensedの場合、text_contentは分割要約を統合したメモ。
+    previous_summaryを指定した場合、text_contentは前回の要約以降に追加された会話ログとして扱う
+    """
     feedback_instruction = ""
     if feedback:
         feedback_instruction = f"""# 追加指示
@@ -49,11 +291,20 @@ def _build_generation_prompt(text_content: str, feedback: str = None) -> str:
 {feedback}
 """
 
+    context = "以下のDiscordの会話ログを分析し、指定されたフォーマットでマークダウン形式の要約を作成してください。"
+    if is_condensed:
+        context = "以下は、長いDiscordの会話ログを分割して要約したメモを順番に並べたものです。これらを統合し、会話全体について指定されたフォーマットでマークダウン形式の要約を作成してください。"
+    if previous_summary:
+        context = f"""以下は、あるDiscordの会話の「前回までの要約」と、その後に追加された会話ログ{"を分割して要約したメモ" if is_condensed else ""}です。前回までの要約に新しい内容を反映し、会話全体について指定されたフォーマットでマークダウン形式の要約を作成し直してください。決定事項やタスクが新しい会話で変更・完了している場合は、最新の状態に更新してください。
+
+[前回までの要約]
+{previous_summary}"""
+
     prompt = f"""# Role
 あなたは、プロの議事録作成アシスタントです。会話のログから、要点、決定事項、そして誰が何をすべきかを正確に抽出する能力に長けています。
 
 # Context
-以下のDiscordの会話ログを分析し、指定されたフォーマットでマークダウン形式の要約を作成してください。
+{context}
 
 # Data
 ---
@@ -72,55 +323,164 @@ def _build_generation_prompt(text_content: str, feedback: str = None) -> str:
     return prompt
 
 def _build_evaluation_prompt(text_content: str, generated_summary: str) -> str:
-    """自己評価用のプロンプトを構築する"""
+    """自己評価用のプロンプトを構築する。評価結果はJSONで出力させる"""
     prompt = f"""# Context
 - 元の会話ログ: ```{text_content}```
 - AIが生成した要約: ```{generated_summary}```
 
 # Instruction
-あなたは品質評価の専門家です。提示された「AIが生成した要約」が、以下の品質基準を全て満たしているかチェックし、Yes/Noで答えてください。もしNoの場合は、どの点がどのように不足しているかを具体的に指摘してください。
+あなたは品質評価の専門家です。提示された「AIが生成した要約」が、以下の品質基準を満たしているかを基準ごとにチェックしてください。
 
-- **網羅性:** 元の会話ログで出た重要な反対意見や懸念事項は、要約に含まれていますか？
-- **正確性:** 決定事項やタスクの担当者、期限は正確に抽出されていますか？
-- **中立性:** 特定の個人の意見に偏らず、議論全体を客観的に要約できていますか？
-- **明瞭性:** 発生したタスクは、誰が見ても誤解なく理解できる形で記述されていますか？
+- **coverage (網羅性):** 元の会話ログで出た重要な反対意見や懸念事項は、要約に含まれていますか？
+- **accuracy (正確性):** 決定事項やタスクの担当者、期限は正確に抽出されていますか？
+- **neutrality (中立性):** 特定の個人の意見に偏らず、議論全体を客観的に要約できていますか？
+- **clarity (明瞭性):** 発生したタスクは、誰が見ても誤解なく理解できる形で記述されていますか？
 
 # Answer
-(ここにYes/Noと具体的な指摘を記述)
+以下の形式のJSONのみを出力してください。JSON以外の文章は書かないでください。
+- 各基準は、満たしていればtrue、満たしていなければfalse
+- scoreは要約全体の品質を0〜100の整数で評価
+- feedbackには、不足している点とその改善方法を具体的に記述 (全て満たしている場合は空文字列)
+
+{{"coverage": true, "accuracy": true, "neutrality": true, "clarity": true, "score": 85, "feedback": ""}}
 """
     return prompt
 
 
-def generate_knowledge_from_text(text_content: str) -> str | None:
+def _parse_evaluation(evaluation_result: str) -> Dict[str, Any] | None:
+    """
+    自己評価の応答からJSONを取り出して検証する。
+    戻り値は {"score": 0〜100, "failed": 満たしていない基準の表示名のリスト, "feedback": 指摘} 。解析できない場合はNone
+    """
+    match = re.search(r"\{.*\}", evaluation_result, re.DOTALL)
+    if not match:
+        return None
+    try:
+        data = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    verdicts = {key: data.get(key) for key in EVALUATION_CRITERIA}
+    if not all(isinstance(v, bool) for v in verdicts.values()):
+        return None
+    failed = [name for key, name in EVALUATION_CRITERIA.items() if not verdicts[key]]
+
+    score = data.get("score")
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 100:
+        # スコアが無い・範囲外の場合は、満たした基準の割合から求める
+        score = 100 * (len(EVALUATION_CRITERIA) - len(failed)) / len(EVALUATION_CRITERIA)
+
+    feedback = data.get("feedback")
+    return {"score": score, "failed": failed, "feedback": feedback if isinstance(feedback, str) else ""}
+
+
+def _format_feedback(evaluation: Dict[str, Any]) -> str:
+    """再生成のプロンプトに渡すため、評価結果を文章にまとめる"""
+    lines = [f"スコア: {evaluation['score']:.0f}/100"]
+    if evaluation["failed"]:
+        lines.append(f"満たしていない基準: {'、'.join(evaluation['failed'])}")
+    if evaluation["feedback"]:
+        lines.append(f"指摘: {evaluation['feedback']}")
+    return "\n".join(lines)
+
+
+def get_evaluation_stats() -> Dict[str, int]:
+    """自己評価の結果ごとの件数を返す"""
+    return dict(_evaluation_stats)
+
+
+async def generate_knowledge_from_text(
+    text_content: str,
+    priority: int = PRIORITY_BACKGROUND,
+    previous_summary: str | None = None,
+    on_progress: ProgressCallback | None = None,
+) -> str | None:
     """
-    テキストコンテンツを受け取り、自己評価ループを経て高品質なナレッジを生成する
+    テキストコンテンツを受け取り、自己評価ループを経て高品質なナレッジを生成する。
+    previous_summaryを指定した場合は、前回の要約にtext_content(追加分の会話)を反映した要約を生成する。
+    on_progressを指定した場合は、ステップが進むたびと要約の生成中に途中経過を渡して呼び出す
     """
+    # 同じ本文から生成済みであれば、キャッシュした結果をそのまま返す
+    cache_key = _cache_key("knowledge", json.dumps([previous_summary, text_content], ensure_ascii=False))
+    cached = local_store.get_llm_cache(cache_key)
+    if cached is not None:
+        print("AIによるナレッジ生成: キャッシュ済みの結果を利用します。")
+        return cached
+
+    knowledge = await _generate_knowledge(text_content, priority, previous_summary, on_progress or (lambda status, partial: None))
+    if knowledge:
+        local_store.set_llm_cache(cache_key, knowledge, LLM_CACHE_MAX_ENTRIES)
+    return knowledge
+
+
+async def _generate_knowledge(
+    text_content: str, priority: int, previous_summary: str | None, on_progress: ProgressCallback
+) -> str | None:
+    """分割要約 → 一次生成 → 自己評価 → 再生成 の各ステップを実行する。各ステップの応答は_call_llmでキャッシュされる"""
     print("AIによるナレッジ生成を開始します...")
 
+    # 0. 長いページは分割して要約し、以降のステップでは統合した要約メモを元データとして扱う
+    is_condensed = _estimate_tokens(text_content) > LLM_CHUNK_TOKEN_BUDGET
+    if is_condensed:
+        on_progress("長い会話を分割して要約中...", "")
+        text_content = await _condense_long_text(text_content, priority)
+        if not text_content:
+            return None
+
     # 1. 一次生成 (v1)
     print("  - ステップ1/3: 要約の一次生成中...")
-    generation_prompt_v1 = _build_generation_prompt(text_content)
-    summary_v1 = _call_llm(generation_prompt_v1)
+    on_progress("ステップ1/3: 要約を生成中...", "")
+    generation_prompt_v1 = _build_generation_prompt(
+        text_content, is_condensed=is_condensed, previous_summary=previous_summary
+    )
+    summary_v1 = await _call_llm(
+        generation_prompt_v1, priority=priority,
+        on_token=lambda partial: on_progress("ステップ1/3: 要約を生成中...", partial),
+    )
     if not summary_v1:
         print("  - 一次生成に失敗しました。")
         return None
     
     # 2. 自己評価
     print("  - ステップ2/3: 生成された要約の自己評価中...")
-    evaluation_prompt = _build_evaluation_prompt(text_content, summary_v1)
+    on_progress("ステップ2/3: 要約を自己評価中...", summary_v1)
+    # 差分要約の場合、元の会話ログとして前回までの要約と追加分を合わせて評価させる
+    source_for_evaluation = text_content
+    if previous_summary:
+        source_for_evaluation = f"[前回までの要約]\n{previous_summary}\n\n[追加された会話]\n{text_content}"
+    evaluation_prompt = _build_evaluation_prompt(source_for_evaluation, summary_v1)
     # 評価はより決定的な結果を求めるため、temperatureを低めに設定
-    evaluation_result = _call_llm(evaluation_prompt, temperature=0.1)
+    evaluation_result = await _call_llm(evaluation_prompt, temperature=0.1, priority=priority)
     if not evaluation_result:
+        _evaluation_stats["failed"] += 1
         print("  - 自己評価に失敗しました。一次生成の結果をそのまま利用します。")
+        _print_evaluation_stats()
+        return summary_v1
+
+    evaluation = _parse_evaluation(evaluation_result)
+    if evaluation is None:
+        # 形式が崩れた応答で高価な再生成を行わないよう、一次生成の結果を採用する
+        _evaluation_stats["unparsed"] += 1
+        print(f"  - 自己評価の結果を解析できませんでした。一次生成の結果をそのまま利用します: {evaluation_result}")
+        _print_evaluation_stats()
         return summary_v1
 
-    print(f"  - 自己評価の結果: {evaluation_result}")
-    # 簡単な評価結果の解析 (ここでは 'no' が含まれていたら再生成)
-    if 'no' in evaluation_result.lower():
+    print(f"  - 自己評価の結果: {_format_feedback(evaluation)}")
+    if evaluation["score"] < LLM_EVALUATION_THRESHOLD:
+        _evaluation_stats["regenerated"] += 1
+        _print_evaluation_stats()
         print("  - ステップ3/3: 自己評価に基づき、要約を再生成中...")
+        on_progress("ステップ3/3: 自己評価に基づいて要約を再生成中...", "")
         # 3. 修正・再生成 (v2)
-        generation_prompt_v2 = _build_generation_prompt(text_content, feedback=evaluation_result)
-        summary_v2 = _call_llm(generation_prompt_v2)
+        generation_prompt_v2 = _build_generation_prompt(
+            text_content, feedback=_format_feedback(evaluation), is_condensed=is_condensed, previous_summary=previous_summary
+        )
+        summary_v2 = await _call_llm(
+            generation_prompt_v2, priority=priority,
+            on_token=lambda partial: on_progress("ステップ3/3: 自己評価に基づいて要約を再生成中...", partial),
+        )
         if not summary_v2:
             print("  - 再生成に失敗しました。一次生成の結果をそのまま利用します。")
             return summary_v1
@@ -128,5 +488,15 @@ def generate_knowledge_from_text(text_content: str) -> str | None:
         print("  - 再生成が完了しました。")
         return summary_v2
     else:
+        _evaluation_stats["passed"] += 1
+        _print_evaluation_stats()
         print("  - ステップ3/3: 自己評価をクリアしました。")
         return summary_v1
+
+
+def _print_evaluation_stats():
+    stats = _evaluation_stats
+    print(
+        f"  - 自己評価の累計: 合格{stats['passed']}回 / 再生成{stats['regenerated']}回"
+        f" / 解析できず{stats['unparsed']}回 / 評価失敗{stats['failed']}回"
+    )
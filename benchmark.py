@@ -0,0 +1,622 @@
+"""
+外部サービスに接続せずに、同期処理と要約処理の性能を計測するベンチマーク
+
+Discord・Notion・Google Drive・LM-Studioの代わりに、プロセス内で動く偽のサーバー/チャンネルを使う。
+遅延・429(レート制限)・データ量は引数で変更できる。
+
+    python benchmark.py
+    python benchmark.py --threads 20 --messages 50 --attachment-ratio 0.2 --latency 0.1 --rate-limit-every 30
+    python benchmark.py --scenarios sync,summarize --json result.json
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+SCENARIOS = ["fetch", "sync", "page_text", "summarize"]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="偽のDiscord/Notion/Drive/LM-Studioを使ったオフラインベンチマーク")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"実行するシナリオ (カンマ区切り: {', '.join(SCENARIOS)})")
+    # Discordの合成データ
+    parser.add_argument("--threads", type=int, default=5, help="フォーラムのスレッド数")
+    parser.add_argument("--messages", type=int, default=10, help="スレッドあたりのメッセージ数")
+    parser.add_argument("--message-length", type=int, default=200, help="メッセージ本文の文字数")
+    parser.add_argument("--attachment-ratio", type=float, default=0.1, help="添付ファイル付きメッセージの割合")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024, help="添付ファイルのサイズ(バイト)")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Discordの履歴1ページ取得あたりの遅延(秒)")
+    # 偽サーバーの挙動
+    parser.add_argument("--latency", type=float, default=0.05, help="Notion・Driveの1リクエストあたりの平均遅延(秒)")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="N回に1回、429を返す (0で無効)")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="429のRetry-Afterヘッダーの秒数")
+    parser.add_argument("--notion-rate", type=float, default=3, help="Notionへのリクエストレート(回/秒)")
+    # ページ本文の取得
+    parser.add_argument("--page-blocks", type=int, default=300, help="page_textシナリオのページのブロック数")
+    parser.add_argument("--iterations", type=int, default=5, help="page_text・summarizeシナリオの繰り返し回数")
+    # LLM
+    parser.add_argument("--llm-prefill-latency", type=float, default=0.0005, help="入力1トークンあたりの処理時間(秒)")
+    parser.add_argument("--llm-token-latency", type=float, default=0.01, help="出力1トークンあたりの生成時間(秒)")
+    parser.add_argument("--llm-output-tokens", type=int, default=200, help="要約1回あたりの出力トークン数")
+    parser.add_argument("--llm-eval-score", type=int, default=90, help="自己評価で返すスコア (閾値未満にすると再生成の経路を計測できる)")
+    parser.add_argument("--summary-text-length", type=int, default=4000, help="summarizeシナリオの入力本文の文字数")
+    parser.add_argument("--json", help="結果をJSONで書き出すファイル")
+    parser.add_argument("--verbose", action="store_true", help="各ハンドラのログを表示する")
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace):
+    """ハンドラの読み込み前に、設定を環境変数で与える"""
+    os.environ["LOCAL_STORE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="noticord-bench-"), "bench.db")
+    os.environ["NOTION_RATE_LIMIT"] = str(args.notion_rate)
+    os.environ["NOTION_RATE_BURST"] = str(args.notion_rate)
+    for name, value in {
+        "DISCORD_BOT_TOKEN": "bench",
+        "TARGET_CHANNEL_ID": "1",
+        "IDEA_CHANNEL_ID": "2",
+        "NOTION_API_KEY": "bench",
+        "FORM_DATABASE_ID": "form-db",
+        "ASSETS_DATABASE_ID": "assets-db",
+        "DONE_MESSAGES_DATABASE_ID": "done-db",
+        "GOOGLE_DRIVE_FOLDER_ID": "bench-folder",
+    }.items():
+        os.environ.setdefault(name, value)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近傍順位法によるパーセンタイル"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+# --- 偽サーバー (Notion API・Discord CDN・Google Drive・OpenAI互換API) ---
+class FakeServices:
+    """1つのaiohttpサーバーで、各サービスの偽のエンドポイントを提供する"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.base_url = ""
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self._request_counts: Dict[str, int] = {}
+        # Notion
+        self.pages: Dict[str, Dict[str, Any]] = {}
+        self.children: Dict[str, List[Dict[str, Any]]] = {}
+        # Drive
+        self.upload_sessions: Dict[str, Dict[str, int]] = {}
+        self._runner = None
+
+    # --- 計測 ---
+    def reset_stats(self):
+        self.stats = {}
+
+    def _record(self, endpoint: str, started: float, status: int, bytes_in: int, bytes_out: int):
+        stat = self.stats.setdefault(endpoint, {"calls": 0, "rate_limited": 0, "latencies": [], "bytes_in": 0, "bytes_out": 0})
+        stat["calls"] += 1
+        stat["latencies"].append(time.perf_counter() - started)
+        stat["bytes_in"] += bytes_in
+        stat["bytes_out"] += bytes_out
+        if status == 429:
+            stat["rate_limited"] += 1
+
+    def _should_rate_limit(self, service: str) -> bool:
+        every = self.args.rate_limit_every
+        if not every:
+            return False
+        self._request_counts[service] = self._request_counts.get(service, 0) + 1
+        return self._request_counts[service] % every == 0
+
+    async def _latency(self, base: float):
+        if base > 0:
+            await asyncio.sleep(base * random.uniform(0.5, 1.5))
+
+    def _middleware(self):
+        from aiohttp import web
+
+        @web.middleware
+        async def measure(request, handler):
+            started = time.perf_counter()
+            service = request.path.split("/")[1]
+            endpoint = f"{service} {request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}"
+            body = await request.read()
+            if service in ("notion", "drive", "openai") and self._should_rate_limit(service):
+                response = web.json_response(
+                    {"object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited (benchmark)"},
+                    status=429, headers={"Retry-After": str(self.args.retry_after)},
+                )
+            else:
+                response = await handler(request)
+            self._record(endpoint, started, response.status, len(body), response.content_length or 0)
+            return response
+
+        return measure
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application(middlewares=[self._middleware()], client_max_size=1024 ** 3)
+        app.router.add_post("/notion/v1/databases/{database_id}/query", self.notion_query)
+        app.router.add_post("/notion/v1/pages", self.notion_create_page)
+        app.router.add_get("/notion/v1/pages/{page_id}", self.notion_retrieve_page)
+        app.router.add_patch("/notion/v1/pages/{page_id}", self.notion_update_page)
+        app.router.add_get("/notion/v1/blocks/{block_id}/children", self.notion_list_children)
+        app.router.add_patch("/notion/v1/blocks/{block_id}/children", self.notion_append_children)
+        app.router.add_get("/cdn/{attachment_id}/{size}", self.cdn_download)
+        app.router.add_post("/drive/upload", self.drive_start_upload)
+        app.router.add_put("/drive/session/{session_id}", self.drive_put)
+        app.router.add_post("/openai/v1/chat/completions", self.openai_chat)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    # --- Notion API ---
+    @staticmethod
+    def _now() -> str:
+        return datetime.now(timezone.utc).isoformat()
+
+    @staticmethod
+    def _with_plain_text(properties: Dict[str, Any]) -> Dict[str, Any]:
+        """本物のAPIと同様に、リッチテキストにplain_textを付けて返す"""
+        for prop in properties.values():
+            for key in ("title", "rich_text"):
+                for item in prop.get(key, []):
+                    item.setdefault("plain_text", item.get("text", {}).get("content", ""))
+        return properties
+
+    def _new_block(self, block: Dict[str, Any]) -> Dict[str, Any]:
+        block_id = str(uuid.uuid4())
+        children = block.pop("children", None) or block.get(block.get("type"), {}).pop("children", None)
+        block_type = block.get("type")
+        for item in block.get(block_type, {}).get("rich_text", []):
+            item.setdefault("plain_text", item.get("text", {}).get("content", ""))
+        stored = {**block, "object": "block", "id": block_id, "has_children": bool(children), "last_edited_time": self._now()}
+        self.children[block_id] = [self._new_block(child) for child in children or []]
+        return stored
+
+    def add_page(self, parent: Dict[str, Any], properties: Dict[str, Any], children=None) -> Dict[str, Any]:
+        page_id = str(uuid.uuid4())
+        page = {
+            "object": "page", "id": page_id, "parent": parent,
+            "properties": self._with_plain_text(properties),
+            "archived": False, "in_trash": False, "last_edited_time": self._now(),
+        }
+        self.pages[page_id] = page
+        self.children[page_id] = [self._new_block(block) for block in children or []]
+        return page
+
+    def _paginate(self, items: list, start_cursor: str | None, page_size: int) -> Dict[str, Any]:
+        start = int(start_cursor) if start_cursor else 0
+        end = start + page_size
+        return {
+            "object": "list", "results": items[start:end],
+            "has_more": end < len(items), "next_cursor": str(end) if end < len(items) else None,
+        }
+
+    async def notion_query(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        body = await request.json() if request.body_exists else {}
+        database_id = request.match_info["database_id"]
+        pages = [p for p in self.pages.values() if p["parent"].get("database_id") == database_id]
+        query_filter = body.get("filter") or {}
+        if "property" in query_filter:
+            expected = query_filter.get("rich_text", {}).get("equals")
+            pages = [
+                p for p in pages
+                if "".join(t["plain_text"] for t in p["properties"].get(query_filter["property"], {}).get("rich_text", [])) == expected
+            ]
+        return web.json_response(self._paginate(pages, body.get("start_cursor"), body.get("page_size", 100)))
+
+    async def notion_create_page(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        body = await request.json()
+        return web.json_response(self.add_page(body["parent"], body.get("properties", {}), body.get("children")))
+
+    async def notion_retrieve_page(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        page = self.pages.get(request.match_info["page_id"])
+        if not page:
+            return web.json_response({"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"}, status=404)
+        return web.json_response(page)
+
+    async def notion_update_page(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        page = self.pages[request.match_info["page_id"]]
+        body = await request.json()
+        page["properties"].update(self._with_plain_text(body.get("properties", {})))
+        page["last_edited_time"] = self._now()
+        return web.json_response(page)
+
+    async def notion_list_children(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        blocks = self.children.get(request.match_info["block_id"], [])
+        return web.json_response(self._paginate(
+            blocks, request.query.get("start_cursor"), int(request.query.get("page_size", 100))
+        ))
+
+    async def notion_append_children(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        body = await request.json()
+        new_blocks = [self._new_block(block) for block in body.get("children", [])]
+        self.children.setdefault(request.match_info["block_id"], []).extend(new_blocks)
+        return web.json_response({"object": "list", "results": new_blocks, "has_more": False, "next_cursor": None})
+
+    # --- Discord CDN ---
+    async def cdn_download(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        size = int(request.match_info["size"])
+        # 添付ファイルごとに内容が異なるよう、IDから生成したバイト列を繰り返す
+        seed = request.match_info["attachment_id"].encode()
+        data = (seed * (size // len(seed) + 1))[:size]
+        return web.Response(body=data, content_type="application/octet-stream")
+
+    # --- Google Drive (再開可能アップロード) ---
+    async def drive_start_upload(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        session_id = str(uuid.uuid4())
+        self.upload_sessions[session_id] = {"total": int(request.headers["X-Upload-Content-Length"]), "received": 0}
+        return web.Response(status=200, headers={"Location": f"{self.base_url}/drive/session/{session_id}"})
+
+    async def drive_put(self, request):
+        from aiohttp import web
+        await self._latency(self.args.latency)
+        session = self.upload_sessions.get(request.match_info["session_id"])
+        if not session:
+            return web.Response(status=404)
+        content_range = request.headers.get("Content-Range", "")
+        if not content_range.startswith("bytes */"):
+            data = await request.read()
+            start = int(content_range.split(" ")[1].split("-")[0])
+            if start == session["received"]:
+                session["received"] += len(data)
+        if session["received"] >= session["total"]:
+            file_id = request.match_info["session_id"]
+            return web.json_response({"id": file_id, "webViewLink": f"https://drive.example/{file_id}"})
+        headers = {"Range": f"bytes=0-{session['received'] - 1}"} if session["received"] else {}
+        return web.Response(status=308, headers=headers)
+
+    # --- OpenAI互換API (LM-Studio) ---
+    async def openai_chat(self, request):
+        from aiohttp import web
+        body = await request.json()
+        prompt = body["messages"][-1]["content"]
+        if "品質評価" in prompt:
+            tokens = [json.dumps({
+                "coverage": True, "accuracy": True, "neutrality": True, "clarity": True,
+                "score": self.args.llm_eval_score, "feedback": "",
+            })]
+        else:
+            # 本物のLLMと同じく入力ごとに異なる応答にする (同じ応答だと、後段のプロンプトが応答キャッシュに当たる)
+            digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:8]
+            tokens = [f"- 要点{digest}"] + ["- 要点"] * (self.args.llm_output_tokens - 1)
+        await asyncio.sleep(len(prompt) * self.args.llm_prefill_latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) * self.args.llm_token_latency)
+            return web.json_response({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(tokens), "total_tokens": len(prompt) + len(tokens)},
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(self.args.llm_token_latency)
+            chunk = {
+                "id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+# --- 偽のDiscordチャンネル ---
+def build_fake_forum(args: argparse.Namespace, base_url: str):
+    """N スレッド × M メッセージのフォーラムを合成する"""
+    import discord
+
+    class FakeAuthor:
+        def __init__(self, name: str):
+            self.display_name = name
+
+    class FakeAttachment:
+        def __init__(self, attachment_id: int, size: int):
+            self.id = attachment_id
+            self.filename = f"file-{attachment_id}.bin"
+            self.size = size
+            self.content_type = "application/octet-stream"
+            self.url = f"{base_url}/cdn/{attachment_id}/{size}"
+
+    class FakeMessage:
+        def __init__(self, message_id: int, channel, content: str, attachments: list):
+            self.id = message_id
+            self.channel = channel
+            self.guild = channel.guild
+            self.content = content
+            self.author = FakeAuthor(f"user{message_id % 7}")
+            self.attachments = attachments
+            self.created_at = discord.utils.snowflake_time(message_id)
+
+    class FakeThread(discord.Thread):
+        guild = None
+
+        def __init__(self, thread_id: int, name: str, guild):
+            self.id = thread_id
+            self.name = name
+            self.guild = guild
+            self.messages: list = []
+            self.last_message_id = None
+            self.archive_timestamp = datetime.now(timezone.utc)
+
+        async def history(self, limit=None, after=None, oldest_first=None, **kwargs):
+            after_id = after.id if after else 0
+            messages = [m for m in self.messages if m.id > after_id]
+            for start in range(0, len(messages), 100):
+                # 本物と同様に100件ごとにAPIを呼び出す
+                await asyncio.sleep(args.discord_latency)
+                for message in messages[start:start + 100]:
+                    yield message
+
+    class FakeForum(discord.ForumChannel):
+        threads = None
+
+        def __init__(self, channel_id: int, threads: list):
+            self.id = channel_id
+            self.name = "bench-forum"
+            self.threads = threads
+
+        async def archived_threads(self, **kwargs):
+            return
+            yield
+
+    class FakeGuild:
+        id = 1000
+
+    rng = random.Random(0)
+    guild = FakeGuild()
+    started = datetime.now(timezone.utc) - timedelta(minutes=30)
+    next_id = discord.utils.time_snowflake(started)
+    threads = []
+    message_count = 0
+    attachment_count = 0
+    for t in range(args.threads):
+        next_id += 1000
+        thread = FakeThread(next_id, f"ベンチマーク用スレッド{t + 1}", guild)
+        for _ in range(args.messages):
+            next_id += 1000
+            attachments = []
+            if rng.random() < args.attachment_ratio:
+                # サイズが重複すると重複チェックでハッシュ計算が走るため、少しずつずらす
+                attachments.append(FakeAttachment(next_id + 1, args.attachment_size + attachment_count))
+                attachment_count += 1
+            content = "".join(rng.choice("会議議題決定事項担当者期限確認") for _ in range(args.message_length))
+            thread.messages.append(FakeMessage(next_id, thread, content, attachments))
+            message_count += 1
+        thread.last_message_id = thread.messages[-1].id if thread.messages else None
+        threads.append(thread)
+    return FakeForum(1, threads), message_count, attachment_count
+
+
+# --- シナリオ ---
+@contextlib.contextmanager
+def quiet(verbose: bool):
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+def endpoint_report(services: FakeServices) -> List[Dict[str, Any]]:
+    return [
+        {
+            "endpoint": endpoint,
+            "calls": stat["calls"],
+            "rate_limited": stat["rate_limited"],
+            "p50_ms": percentile(stat["latencies"], 50) * 1000,
+            "p99_ms": percentile(stat["latencies"], 99) * 1000,
+            "bytes_in": stat["bytes_in"],
+            "bytes_out": stat["bytes_out"],
+        }
+        for endpoint, stat in sorted(services.stats.items())
+    ]
+
+
+def print_result(result: Dict[str, Any]):
+    print(f"\n=== {result['scenario']} ===")
+    for key, value in result["summary"].items():
+        print(f"  {key}: {value:.3f}" if isinstance(value, float) else f"  {key}: {value}")
+    if result["endpoints"]:
+        print(f"  {'エンドポイント':<52} {'回数':>6} {'429':>5} {'p50(ms)':>9} {'p99(ms)':>9} {'要求(B)':>11} {'応答(B)':>11}")
+        for e in result["endpoints"]:
+            print(
+                f"  {e['endpoint']:<52} {e['calls']:>6} {e['rate_limited']:>5} {e['p50_ms']:>9.1f} {e['p99_ms']:>9.1f}"
+                f" {e['bytes_in']:>11} {e['bytes_out']:>11}"
+            )
+
+
+async def run_fetch(args, services, forum, message_count, _) -> Dict[str, Any]:
+    import discord_handler
+    import sync_targets
+    started = time.perf_counter()
+    with quiet(args.verbose):
+        messages = await discord_handler.get_today_messages(forum, sync_targets.DEFAULT_TARGET)
+    elapsed = time.perf_counter() - started
+    return {
+        "summary": {
+            "経過時間(秒)": elapsed,
+            "取得メッセージ数": len(messages),
+            "メッセージ/秒": len(messages) / elapsed if elapsed else 0.0,
+            "期待メッセージ数": message_count,
+        },
+    }
+
+
+async def run_sync(args, services, forum, message_count, attachment_count) -> Dict[str, Any]:
+    import discord_handler
+    import notion_handler
+    before = notion_handler.scheduler.get_stats()
+    started = time.perf_counter()
+    with quiet(args.verbose):
+        result = await discord_handler.sync_messages()
+    statuses = sorted({target_result["status"] for target_result in result["results"].values()})
+    elapsed = time.perf_counter() - started
+    after = notion_handler.scheduler.get_stats()
+    return {
+        "summary": {
+            "結果": ",".join(statuses),
+            "経過時間(秒)": elapsed,
+            "メッセージ数": message_count,
+            "添付ファイル数": attachment_count,
+            "メッセージ/秒": message_count / elapsed if elapsed else 0.0,
+            "Notionリクエスト": after["requests"] - before["requests"],
+            "Notion再試行": after["retries"] - before["retries"],
+            "Notionレート待機(秒)": after["total_wait_seconds"] - before["total_wait_seconds"],
+        },
+    }
+
+
+async def run_page_text(args, services, *_) -> Dict[str, Any]:
+    import notion_handler
+    blocks = []
+    for i in range(args.page_blocks):
+        text = {"rich_text": [{"type": "text", "text": {"content": f"ブロック{i}の本文です。" * 5}}]}
+        if i % 10 == 9:
+            # 入れ子のトグルを混ぜて、子ブロックの再帰取得を発生させる
+            children = [{"type": "paragraph", "paragraph": {"rich_text": [{"type": "text", "text": {"content": f"子ブロック{i}-{j}"}}]}} for j in range(3)]
+            blocks.append({"type": "toggle", "toggle": text, "children": children})
+        else:
+            blocks.append({"type": "paragraph", "paragraph": text})
+    page = services.add_page({"database_id": "form-db"}, {}, blocks)
+
+    durations = []
+    text = ""
+    for _ in range(args.iterations):
+        started = time.perf_counter()
+        with quiet(args.verbose):
+            text = await notion_handler.get_all_text_from_page(page["id"])
+        durations.append(time.perf_counter() - started)
+    return {
+        "summary": {
+            "回数": args.iterations,
+            "初回(秒)": durations[0],
+            "p50(秒)": percentile(durations, 50),
+            "p99(秒)": percentile(durations, 99),
+            "抽出文字数": len(text),
+        },
+    }
+
+
+async def run_summarize(args, services, *_) -> Dict[str, Any]:
+    import AI_handler
+    durations = []
+    first_output = []
+    stats_before = AI_handler.get_evaluation_stats()
+    for i in range(args.iterations):
+        # 応答キャッシュに当たらないよう、毎回異なる本文にする (偽のLLMも本文ごとに異なる要約を返す)
+        text = f"[{i}] " + "".join(random.choice("議論決定課題担当期限確認\n") for _ in range(args.summary_text_length))
+        first_output_at = []
+        started = time.perf_counter()
+
+        def on_progress(status: str, partial: str):
+            if partial and not first_output_at:
+                first_output_at.append(time.perf_counter())
+
+        with quiet(args.verbose):
+            await AI_handler.generate_knowledge_from_text(text, priority=AI_handler.PRIORITY_INTERACTIVE, on_progress=on_progress)
+        durations.append(time.perf_counter() - started)
+        if first_output_at:
+            first_output.append(first_output_at[0] - started)
+    stats_after = AI_handler.get_evaluation_stats()
+    return {
+        "summary": {
+            "回数": args.iterations,
+            "p50(秒)": percentile(durations, 50),
+            "p99(秒)": percentile(durations, 99),
+            "最初の出力までp50(秒)": percentile(first_output, 50),
+            "再生成した回数": stats_after["regenerated"] - stats_before["regenerated"],
+        },
+    }
+
+
+async def main(args: argparse.Namespace) -> int:
+    from notion_client import AsyncClient
+    from openai import AsyncOpenAI
+
+    import AI_handler
+    import discord_handler
+    import google_drive_handler
+    import notion_handler
+
+    services = FakeServices(args)
+    await services.start()
+
+    # 各ハンドラの接続先を偽サーバーに差し替える
+    notion_handler.notion = AsyncClient(auth="bench", base_url=f"{services.base_url}/notion", client=notion_handler._http_client)
+    google_drive_handler.DRIVE_UPLOAD_URL = f"{services.base_url}/drive/upload"
+
+    async def fake_access_token() -> str:
+        return "bench-token"
+
+    google_drive_handler._get_access_token = fake_access_token
+    AI_handler.client = AsyncOpenAI(base_url=f"{services.base_url}/openai/v1", api_key="bench", max_retries=5)
+    forum, message_count, attachment_count = build_fake_forum(args, services.base_url)
+    discord_handler.bot.get_channel = lambda channel_id: forum if channel_id == forum.id else None
+
+    runners = {"fetch": run_fetch, "sync": run_sync, "page_text": run_page_text, "summarize": run_summarize}
+    results = []
+    try:
+        for name in args.scenarios.split(","):
+            name = name.strip()
+            if name not in runners:
+                print(f"不明なシナリオです: {name}")
+                return 1
+            services.reset_stats()
+            result = await runners[name](args, services, forum, message_count, attachment_count)
+            result = {"scenario": name, **result, "endpoints": endpoint_report(services)}
+            print_result(result)
+            results.append(result)
+    finally:
+        await google_drive_handler.close_http_session()
+        await services.stop()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を {args.json} に書き出しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    configure_environment(arguments)
+    sys.exit(asyncio.run(main(arguments)))
@@ -1,21 +1,49 @@
+import asyncio
+import heapq
 import os
 import re
+import time
 from datetime import datetime, timedelta, timezone
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import discord.app_commands
 
 import google_drive_handler
+import local_store
+import metrics
 import notion_handler
 import AI_handler
+import rate_limiter
+import sync_targets
+from sync_targets import SyncTarget
 from utils import split_message
 
 # 環境変数から設定を取得
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
-TARGET_CHANNEL_ID = int(os.getenv("TARGET_CHANNEL_ID"))
 IDEA_CHANNEL_ID = int(os.getenv("IDEA_CHANNEL_ID"))
-GUILD_ID = os.getenv("GUILD_ID")  # 即時反映させたいサーバーID(任意)
+# 即時反映させたいサーバーID(任意)。複数のサーバーで使う場合はカンマ区切りで指定する
+GUILD_IDS = [guild_id.strip() for guild_id in os.getenv("GUILD_ID", "").split(",") if guild_id.strip()]
+# 添付ファイルを並行して処理する数(全ての同期対象で共有)と、1ファイルあたりのタイムアウト(秒)
+ATTACHMENT_CONCURRENCY = int(os.getenv("ATTACHMENT_CONCURRENCY", "4"))
+ATTACHMENT_TIMEOUT = float(os.getenv("ATTACHMENT_TIMEOUT", "600"))
+# 失敗した書き込み操作を再試行する上限回数と、完了した操作の記録を残す期間(秒)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_RETENTION = 30 * 24 * 60 * 60
+# リアルタイム同期: 新着メッセージをキューに積み、一定間隔でまとめてNotionに書き込む
+REALTIME_SYNC = os.getenv("REALTIME_SYNC", "false").lower() in ("1", "true", "yes")
+REALTIME_FLUSH_INTERVAL = float(os.getenv("REALTIME_FLUSH_INTERVAL", "5"))
+# キューのメッセージをこの回数失敗したら諦め、定時同期に任せる
+REALTIME_MAX_ATTEMPTS = 5
+# /summarizeの途中経過でメッセージを編集する最短間隔(秒) (Discordの編集レート制限を超えないようにする)
+SUMMARY_EDIT_INTERVAL = float(os.getenv("SUMMARY_EDIT_INTERVAL", "2"))
+# Discordのメッセージ上限(2000文字)に収まるよう、途中経過の本文は末尾のこの文字数だけ表示する
+SUMMARY_PREVIEW_LENGTH = 1500
+# /searchで表示する件数と、1件あたりの本文の抜粋の文字数
+SEARCH_RESULT_LIMIT = 8
+SEARCH_SNIPPET_LENGTH = 80
+
+JST = timezone(timedelta(hours=+9), 'JST')
 
 # Intents設定
 intents = discord.Intents.default()
@@ -25,6 +53,11 @@ intents.message_content = True
 # Botのインスタンスを作成
 bot = commands.Bot(command_prefix="/", intents=intents)
 
+# 全ての同期対象で共有する添付ファイル処理の同時実行枠 (空いた枠は同期対象ごとに順番に割り当てる)
+_attachment_semaphore = rate_limiter.FairSemaphore(ATTACHMENT_CONCURRENCY)
+# キューに積んだメッセージのうち、このプロセスで受信したもの (再起動後はDiscordから取り直す)
+_pending_messages: dict[int, discord.Message] = {}
+
 
 # --- イベントリスナー ---
 @bot.event
@@ -33,53 +66,162 @@ async def on_ready():
     print(f"{bot.user} としてログインしました")
 
     # スラッシュコマンドを同期
-    if GUILD_ID:
-        guild = discord.Object(id=GUILD_ID)
-        await bot.tree.sync(guild=guild)
-        print(f"コマンドをサーバー {GUILD_ID} に同期しました。")
+    if GUILD_IDS:
+        for guild_id in GUILD_IDS:
+            await bot.tree.sync(guild=discord.Object(id=guild_id))
+            print(f"コマンドをサーバー {guild_id} に同期しました。")
     else:
         await bot.tree.sync()
         print("コマンドをグローバルに同期しました。")
 
+    if REALTIME_SYNC and not flush_pending_messages.is_running():
+        flush_pending_messages.start()
+        print(f"リアルタイム同期を開始しました。({REALTIME_FLUSH_INTERVAL:.0f}秒ごとに書き込み)")
+
+
+@bot.listen("on_message")
+async def enqueue_new_message(message: discord.Message):
+    """同期対象のスレッドに投稿されたメッセージを書き込み待ちキューに積む"""
+    if not REALTIME_SYNC or message.author == bot.user:
+        return
+    channel = message.channel
+    if not isinstance(channel, discord.Thread) or not sync_targets.find_target_by_channel(channel.parent_id):
+        return
+    local_store.enqueue_pending_message(str(message.id), str(channel.id))
+    _pending_messages[message.id] = message
+
 
 # --- スラッシュコマンド ---
-@bot.tree.command(name="sync", description="DiscordのメッセージをNotionに手動で同期します。")
-async def sync_command(interaction: discord.Interaction):
-    """/syncコマンドの実装。詳細な結果を返すように変更。"""
-    await interaction.response.defer(ephemeral=True)
-    try:
-        result = await sync_messages()
+async def _target_name_autocomplete(interaction: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+    return [
+        discord.app_commands.Choice(name=target.name, value=target.name)
+        for target in sync_targets.SYNC_TARGETS if current.lower() in target.name.lower()
+    ][:25]
 
-        if result["status"] == "SUCCESS":
-            summary = result.get("summary", [])
-            if not summary:
-                await interaction.followup.send("同期対象となる新しいメッセージはありませんでした。")
-                return
 
-            message_lines = ["同期成功です。"]
-            message_lines.extend(f"- {s}" for s in summary[:3])
-            if len(summary) > 3:
-                message_lines.append(f"...他{len(summary) - 3}件の処理を行いました。")
-            await interaction.followup.send("\n".join(message_lines))
+def _format_sync_result(result: dict) -> list[str]:
+    """1つの同期対象の同期結果を、応答メッセージの行のリストにする"""
+    if result["status"] == "SUCCESS":
+        summary = result.get("summary", [])
+        if not summary:
+            return ["同期対象となる新しいメッセージはありませんでした。"]
+        lines = ["同期成功です。"]
+        lines.extend(f"- {s}" for s in summary[:3])
+        if len(summary) > 3:
+            lines.append(f"...他{len(summary) - 3}件の処理を行いました。")
+        return lines
+    if result["status"] == "NO_NEW_MESSAGES":
+        return ["全て同期済みです。"]
+    return [f"同期エラーが発生しました:\n`{result.get('error_message', '不明なエラー')}`"]
 
-        elif result["status"] == "NO_NEW_MESSAGES":
-            await interaction.followup.send("全て同期済みです。")
 
-        elif result["status"] == "ERROR":
-            error_msg = result.get("error_message", "不明なエラー")
-            await interaction.followup.send(f"同期エラーが発生しました:\n`{error_msg}`")
+@bot.tree.command(name="sync", description="DiscordのメッセージをNotionに手動で同期します。")
+@discord.app_commands.describe(target="同期する対象の名前（省略すると全ての同期対象）")
+@discord.app_commands.autocomplete(target=_target_name_autocomplete)
+async def sync_command(interaction: discord.Interaction, target: str | None = None):
+    """/syncコマンドの実装。同期対象ごとの結果を返す"""
+    await interaction.response.defer(ephemeral=True)
+    try:
+        if target and not sync_targets.get_target(target):
+            await interaction.followup.send(f"同期対象「{target}」は設定されていません。")
+            return
+        targets = [sync_targets.get_target(target)] if target else sync_targets.SYNC_TARGETS
+        running = [t for t in targets if t.coordinator.is_running]
+        if running:
+            await interaction.followup.send(
+                "同期は既に実行中のため、完了を待って結果をお知らせします。\n現在の状況:\n"
+                + "\n".join(f"- {t.name}: {t.coordinator.describe()}" for t in running)
+            )
+        result = await sync_messages(target)
+
+        results = result["results"]
+        if len(results) == 1:
+            message_lines = _format_sync_result(next(iter(results.values())))
+        else:
+            message_lines = []
+            for name, target_result in results.items():
+                lines = _format_sync_result(target_result)
+                message_lines.append(f"**{name}**: {lines[0]}")
+                message_lines.extend(lines[1:])
+        if result.get("metrics") and any(r["status"] == "SUCCESS" and r.get("summary") for r in results.values()):
+            message_lines.append("計測:")
+            message_lines.extend(f"- {line}" for line in result["metrics"])
+        await interaction.followup.send("\n".join(message_lines)[:2000])
 
     except Exception as e:
         print(f"sync_commandで予期せぬエラーが発生しました: {e}")
         await interaction.followup.send(f"予期せぬ重大なエラーが発生しました:\n`{e}`")
 
 
+class SummaryProgress:
+    """要約の途中経過を受け取り、一定間隔でまとめて/summarizeの応答メッセージに反映する"""
+
+    def __init__(self, interaction: discord.Interaction, view: discord.ui.View):
+        self.interaction = interaction
+        self.view = view
+        self.status = ""
+        self.partial = ""
+        self._changed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def update(self, status: str, partial: str):
+        """AI_handlerから呼び出される。ここでは記録するだけで、編集はバックグラウンドで行う"""
+        self.status = status
+        self.partial = partial
+        self._changed.set()
+
+    def _render(self) -> str:
+        content = f"⏳ {self.status}"
+        if self.partial:
+            preview = self.partial[-SUMMARY_PREVIEW_LENGTH:]
+            if len(self.partial) > SUMMARY_PREVIEW_LENGTH:
+                preview = "…" + preview
+            content += f"\n\n{preview}"
+        return content
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                await self.interaction.edit_original_response(content=self._render(), view=self.view)
+            except discord.HTTPException as e:
+                print(f"要約の途中経過の表示に失敗しました: {e}")
+            # 編集の間隔を空け、その間に届いた更新は次の編集にまとめる
+            await asyncio.sleep(SUMMARY_EDIT_INTERVAL)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class CancelSummaryView(discord.ui.View):
+    """実行中の要約を中止するボタン"""
+
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.task: asyncio.Task | None = None
+
+    @discord.ui.button(label="中止", style=discord.ButtonStyle.danger)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.defer()
+        if self.task and not self.task.done():
+            print("ユーザーの操作により要約を中止します。")
+            self.task.cancel()
+
+
 @bot.tree.command(name="summarize", description="指定したNotionページの議論をAIが要約します。")
 @discord.app_commands.describe(url="要約したいNotionページのURL")
 async def summarize_command(interaction: discord.Interaction, url: str):
     """/summarizeコマンドの実装"""
     await interaction.response.defer(ephemeral=True)
-    await interaction.followup.send(f"要約処理を開始します...これには数分かかる場合があります。")
+    queue_depth = AI_handler.get_queue_depth()
+    waiting = f"（AIの処理待ち: {queue_depth}件）" if queue_depth else ""
+    await interaction.followup.send(f"要約処理を開始します...これには数分かかる場合があります。{waiting}")
 
     # 1. URLからNotionのページIDを抽出
     match = re.search(r'([a-f0-9]{32})$', url.split('?')[0])
@@ -89,23 +231,56 @@ async def summarize_command(interaction: discord.Interaction, url: str):
     page_id = match.group(1)
 
     try:
-        # 2. Notionからページの全テキストを取得
+        # 2. Notionからページのテキストを取得 (前回要約したことがあれば、それ以降に追加された分のみ)
         print(f"Notionページ ({page_id}) からテキストを取得中...")
-        text_content = notion_handler.get_all_text_from_page(page_id)
+        previous = local_store.get_page_summary(page_id)
+        last_block_id, previous_summary = previous if previous else (None, None)
+        text_content, new_last_block_id, is_incremental = await notion_handler.get_page_text_since(page_id, last_block_id)
+        if not is_incremental:
+            previous_summary = None
         if not text_content:
-            await interaction.edit_original_response(content=f"ページにテキストが見つかりませんでした。 (ID: {page_id})")
+            if is_incremental:
+                await interaction.edit_original_response(content=f"前回の要約以降、新しい発言はありません。 (ID: {page_id})")
+            else:
+                await interaction.edit_original_response(content=f"ページにテキストが見つかりませんでした。 (ID: {page_id})")
             return
 
-        # 3. AIハンドラに要約を依頼
-        print("AIに要約を依頼中...")
-        summary = AI_handler.generate_knowledge_from_text(text_content)
+        # 3. AIハンドラに要約を依頼 (生成中の要約を逐次表示し、中止ボタンで止められるようにする)
+        print("AIに要約を依頼中..." + (" (前回の要約に追加分を反映)" if previous_summary else ""))
+        view = CancelSummaryView()
+        progress = SummaryProgress(interaction, view)
+        progress.update(f"AIの処理を待っています...{waiting}", "")
+        progress.start()
+        view.task = asyncio.create_task(AI_handler.generate_knowledge_from_text(
+            text_content,
+            priority=AI_handler.PRIORITY_INTERACTIVE,
+            previous_summary=previous_summary,
+            on_progress=progress.update,
+        ))
+        try:
+            await asyncio.wait([view.task])
+        finally:
+            await progress.stop()
+            if not view.task.done():
+                # このコマンド自体がキャンセルされた場合は、要約も止める
+                view.task.cancel()
+            # 途中経過の編集でBotに登録されたビューを解放する (timeout=Noneのため、止めないと残り続ける)
+            view.stop()
+        if view.task.cancelled():
+            await interaction.edit_original_response(content="要約を中止しました。", view=None)
+            return
+        summary = view.task.result()
         if not summary:
-            await interaction.edit_original_response(content="AIによる要約の生成に失敗しました。LM-Studioのログを確認してください。")
+            await interaction.edit_original_response(content="AIによる要約の生成に失敗しました。LM-Studioのログを確認してください。", view=None)
             return
 
         # 4. 要約をNotionページに追記
         print("要約をNotionページに書き込み中...")
-        notion_handler.add_summary_to_page(page_id, summary)
+        await interaction.edit_original_response(content="要約をNotionページに書き込み中...", view=None)
+        if not await notion_handler.add_summary_to_page(page_id, summary):
+            await interaction.edit_original_response(content="要約をNotionページに書き込めませんでした。詳細はBotのログを確認してください。")
+            return
+        local_store.set_page_summary(page_id, new_last_block_id, summary)
 
         # 5. 完了を通知
         await interaction.edit_original_response(content=f"要約が完了しました！\nNotionページに結果を追記しましたので、ご確認ください。\n{url}")
@@ -114,110 +289,607 @@ async def summarize_command(interaction: discord.Interaction, url: str):
         print(f"要約処理中にエラーが発生しました: {e}")
         import traceback
         traceback.print_exc()
-        await interaction.edit_original_response(content=f"要約処理中にエラーが発生しました。詳細はBotのログを確認してください。\n`{e}`")
+        await interaction.edit_original_response(content=f"要約処理中にエラーが発生しました。詳細はBotのログを確認してください。\n`{e}`", view=None)
+
+
+def _search_snippet(content: str, query: str) -> str:
+    """本文のうち、最初に検索語が現れる位置の前後を抜き出す"""
+    content = " ".join(content.split())
+    positions = [p for p in (content.lower().find(term.lower()) for term in query.split()) if p >= 0]
+    start = max(0, min(positions, default=0) - SEARCH_SNIPPET_LENGTH // 4)
+    snippet = content[start:start + SEARCH_SNIPPET_LENGTH]
+    if start > 0:
+        snippet = "…" + snippet
+    if start + SEARCH_SNIPPET_LENGTH < len(content):
+        snippet += "…"
+    return snippet
+
+
+@bot.tree.command(name="search", description="同期済みのスレッドとAIの要約を全文検索します。")
+@discord.app_commands.describe(query="検索語（スペース区切りで複数指定するとすべてを含むものを検索）")
+async def search_command(interaction: discord.Interaction, query: str):
+    """/searchコマンドの実装。ローカルの索引だけを使い、Notion APIは呼び出さない"""
+    started = time.perf_counter()
+    try:
+        results = local_store.search_documents(query, limit=SEARCH_RESULT_LIMIT)
+    except Exception as e:
+        print(f"検索中にエラーが発生しました: {e}")
+        await interaction.response.send_message(f"検索中にエラーが発生しました。\n`{e}`", ephemeral=True)
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not results:
+        await interaction.response.send_message(f"「{query}」に一致するスレッドは見つかりませんでした。", ephemeral=True)
+        return
+
+    lines = [f"「{query}」の検索結果 ({len(results)}件・{elapsed_ms:.0f}ms)"]
+    for result in results:
+        links = []
+        if result["thread_id"] and result["guild_id"]:
+            links.append(f"[Discord](https://discord.com/channels/{result['guild_id']}/{result['thread_id']})")
+        if result["page_id"]:
+            links.append(f"[Notion](https://www.notion.so/{result['page_id']})")
+        lines.append(
+            f"**{result['thread_name'] or '(スレッド名なし)'}** {' / '.join(links)}\n"
+            f"> {result['author']}: {_search_snippet(result['content'], query)}"
+        )
+    await interaction.response.send_message("\n".join(lines)[:2000], ephemeral=True)
 
 
 # --- 同期ロジック ---
-async def get_today_messages(channel):
-    jst = timezone(timedelta(hours=+9), 'JST')
-    today = datetime.now(jst).date()
-    start_of_day = datetime.combine(today, datetime.min.time(), tzinfo=jst)
-    messages = []
-    async def fetch_and_filter(iterable):
-        async for message in iterable:
-            if message.author != bot.user:
-                messages.append(message)
+async def get_today_messages(channel, target: SyncTarget):
+    """前回の同期位置(チェックポイント)以降のメッセージを取得する
+
+    スレッド自身のチェックポイントが無い場合(前回の同期以降に作られたスレッドなど)はチャンネルのチェックポイント
+    (前回の取得開始時点)から取得し、どちらも無い場合のみ当日0時(JST)以降を対象とする。
+    """
+    today = datetime.now(JST).date()
+    start_of_day = datetime.combine(today, datetime.min.time(), tzinfo=JST)
+    channel_checkpoint = local_store.get_checkpoint(str(channel.id)) or discord.utils.time_snowflake(start_of_day)
+    fetch_tasks = []
+
+    def checkpoint_of(source) -> int:
+        return local_store.get_checkpoint(str(source.id)) or channel_checkpoint
+
+    async def fetch_and_filter(source) -> list:
+        after = discord.Object(id=checkpoint_of(source))
+        async with target.worker_semaphore:
+            with metrics.request_timer("Discord", "history"):
+                return [
+                    message async for message in source.history(after=after, oldest_first=True)
+                    if message.author != bot.user
+                ]
+
+    def schedule_fetch(source):
+        fetch_tasks.append(asyncio.create_task(fetch_and_filter(source)))
+
     if isinstance(channel, discord.ForumChannel):
         print("LoadType: Forumチャンネルからメッセージを読み込んでいます...")
         for thread in channel.threads:
-            await fetch_and_filter(thread.history(after=start_of_day, oldest_first=True))
+            if thread.last_message_id and thread.last_message_id > checkpoint_of(thread):
+                schedule_fetch(thread)
+        # アーカイブ済みスレッドはアーカイブ日時の新しい順に返るため、前回の同期より前にアーカイブされたものに達したら打ち切る
+        archived_before = discord.utils.snowflake_time(checkpoint_of(channel))
         async for thread in channel.archived_threads(limit=None):
-            if thread.last_message_id and discord.utils.snowflake_time(thread.last_message_id).astimezone(jst) >= start_of_day:
-                await fetch_and_filter(thread.history(after=start_of_day, oldest_first=True))
+            if thread.archive_timestamp < archived_before:
+                break
+            if thread.last_message_id and thread.last_message_id > checkpoint_of(thread):
+                schedule_fetch(thread)
     elif hasattr(channel, 'history'):
         print("LoadType: Textチャンネルからメッセージを読み込んでいます...")
-        await fetch_and_filter(channel.history(after=start_of_day, oldest_first=True))
+        schedule_fetch(channel)
     else:
         print(f"エラー: チャンネル '{channel.name}' ({channel.type}) はメッセージ履歴をサポートしていません。")
         return []
-    messages.sort(key=lambda m: m.created_at)
-    return messages
-
 
-async def sync_messages() -> dict:
-    """同期処理を行い、結果を辞書型で返す"""
     try:
-        print("DiscordからNotionへのIDベース同期処理を開始します...")
-        summary_logs = []
-
-        processed_message_ids = notion_handler.query_done_message_ids()
-
-        channel = bot.get_channel(TARGET_CHANNEL_ID)
-        if not channel:
-            return {"status": "ERROR", "error_message": f"チャンネルが見つかりません: {TARGET_CHANNEL_ID}"}
-        
-        messages = await get_today_messages(channel)
-        if not messages:
-            print("同期対象の新しいメッセージはありません。")
-            return {"status": "NO_NEW_MESSAGES"}
-
-        unprocessed_messages = [m for m in messages if str(m.id) not in processed_message_ids]
-        print(f"{len(unprocessed_messages)}件の未処理メッセージを処理します。")
-        if not unprocessed_messages:
-            return {"status": "SUCCESS", "summary": []}
-
-        for message in unprocessed_messages:
-            if not isinstance(message.channel, discord.Thread):
-                continue
-
-            thread_id = str(message.channel.id)
-            thread_name = message.channel.name
-            form_page_id = notion_handler.query_form_page_by_thread_id(thread_id)
-            jst_time = message.created_at.astimezone(timezone(timedelta(hours=+9), 'JST'))
-
+        per_source_messages = await asyncio.gather(*fetch_tasks)
+    except Exception:
+        for task in fetch_tasks:
+            task.cancel()
+        raise
+    # スレッドごとの結果は古い順に並んでいるため、k-wayマージで1本の時系列にまとめる
+    return list(heapq.merge(*per_source_messages, key=lambda m: m.created_at))
+
+
+def advance_checkpoints(channel, messages: list, fetch_started_id: int):
+    """処理済みになったメッセージまで、スレッドごとの同期位置を進める
+
+    未処理のメッセージが残ったスレッドは、そのメッセージの手前で止め、次回に再取得させる。
+    全て処理できた場合のみ、チャンネル全体の位置(アーカイブ済みスレッドの走査範囲)を取得開始時点まで進める。
+    """
+    done_ids = local_store.load_done_message_ids()
+    checkpoints = {}
+    blocked_scopes = set()
+    for message in messages:
+        scope_id = str(message.channel.id)
+        if scope_id in blocked_scopes:
+            continue
+        if str(message.id) in done_ids:
+            checkpoints[scope_id] = message.id
+        else:
+            blocked_scopes.add(scope_id)
+    if not blocked_scopes:
+        checkpoints[str(channel.id)] = fetch_started_id
+    local_store.set_checkpoints(checkpoints)
+
+
+async def refresh_done_message_ids(target: SyncTarget) -> set:
+    """ローカルの処理済みインデックスを、前回以降にNotionで編集された行だけで差分更新する
+
+    メッセージIDはDiscord全体で一意のため、インデックスは全ての同期対象で共有する。
+    """
+    meta_key = f"done_messages_synced_at:{target.done_messages_database_id}"
+    since = local_store.get_meta(meta_key)
+    # last_edited_timeは分単位で丸められるため、少し前の時刻を次回の起点にする
+    synced_at = (datetime.now(timezone.utc) - timedelta(minutes=2)).isoformat()
+    new_ids = await notion_handler.query_done_message_ids(since=since, database_id=target.done_messages_database_id)
+    local_store.add_done_message_ids(new_ids)
+    local_store.set_meta(meta_key, synced_at)
+    return local_store.load_done_message_ids()
+
+
+async def refresh_form_page_cache(target: SyncTarget):
+    """スレッドID → FormページIDのキャッシュを更新する。初回はFormデータベースを一巡して全件を読み込む"""
+    meta_key = f"form_pages_synced_at:{target.form_database_id}"
+    since = local_store.get_meta(meta_key)
+    synced_at = (datetime.now(timezone.utc) - timedelta(minutes=2)).isoformat()
+    form_pages = await notion_handler.query_form_pages(since=since, database_id=target.form_database_id)
+    local_store.set_form_page_ids(form_pages, replace=since is None, database_id=target.form_database_id)
+    local_store.set_meta(meta_key, synced_at)
+
+
+async def get_form_page_id(thread_id: str, target: SyncTarget) -> str | None:
+    """キャッシュからFormページIDを引き、無ければNotionに問い合わせてキャッシュする"""
+    form_page_id = local_store.get_form_page_id(thread_id)
+    if form_page_id:
+        return form_page_id
+    form_page_id = await notion_handler.query_form_page_by_thread_id(thread_id, database_id=target.form_database_id)
+    if form_page_id:
+        local_store.set_form_page_ids({thread_id: form_page_id}, database_id=target.form_database_id)
+    return form_page_id
+
+
+def _take_append_batch(pending: list) -> list:
+    """(message, blocks)の列の先頭から、1回のappendで送れる分だけを取り出す"""
+    batch = []
+    block_count = 0
+    char_count = 0
+    while pending:
+        blocks = pending[0][1]
+        text_length = notion_handler.blocks_text_length(blocks)
+        if batch and (
+            block_count + len(blocks) > notion_handler.MAX_BLOCKS_PER_APPEND
+            or char_count + text_length > notion_handler.MAX_CHARS_PER_APPEND
+        ):
+            break
+        batch.append(pending.pop(0))
+        block_count += len(blocks)
+        char_count += text_length
+    return batch
+
+
+async def _upload_attachment(attachment, post_date: str, target: SyncTarget) -> str | None:
+    """添付ファイルをDriveに保存し、AssetページのIDを返す。同じ内容のファイルは既存のものを再利用する"""
+    existing = await google_drive_handler.find_uploaded_file(attachment)
+    # Assetページは同じAssetsデータベースのものだけ再利用する (同期対象を複数にする前の記録は既定の同期対象のもの)
+    if existing and existing["asset_page_id"] and (
+        existing["assets_database_id"] or sync_targets.DEFAULT_TARGET.assets_database_id
+    ) == target.assets_database_id:
+        print(f"添付ファイル {attachment.filename} は登録済みのため、既存のAssetページを再利用します。")
+        return existing["asset_page_id"]
+
+    if existing:
+        file_url = existing["file_url"]
+    else:
+        file_url = await google_drive_handler.upload_to_drive(attachment, folder_id=target.drive_folder_id)
+    if not file_url:
+        return None
+    asset_id = await notion_handler.create_asset_page(
+        file_name=attachment.filename, file_url=file_url,
+        file_type=attachment.content_type or 'Unknown',
+        file_size=attachment.size, post_date=post_date,
+        database_id=target.assets_database_id,
+    )
+    if asset_id:
+        local_store.set_attachment_asset_page(str(attachment.id), asset_id, target.assets_database_id)
+    return asset_id
+
+
+async def process_attachment(attachment, post_date: str, target: SyncTarget) -> str | None:
+    """同時実行数とタイムアウトを守りながら添付ファイルを処理する"""
+    async with _attachment_semaphore:
+        try:
+            return await asyncio.wait_for(_upload_attachment(attachment, post_date, target), ATTACHMENT_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"添付ファイル {attachment.filename} の処理が{ATTACHMENT_TIMEOUT:.0f}秒以内に終わらなかったため中断しました。")
+            return None
+
+
+async def create_message_assets(message, form_page_id: str, target: SyncTarget) -> int:
+    """メッセージの添付ファイルを並行して処理し、全て終わってからFormページに関連付ける。件数を返す
+
+    添付ファイルごとの処理はアウトボックスに記録し、失敗したものは次回以降の同期で再試行する。
+    """
+    post_date = message.created_at.astimezone(JST).isoformat()
+    attachments = []
+    for attachment in message.attachments:
+        op_key = f"asset:{message.id}:{attachment.id}"
+        op = local_store.get_operation(op_key)
+        if not op or op["status"] != "committed":
+            attachments.append((op_key, attachment))
+    local_store.plan_operations([
+        (op_key, "asset", {
+            "message_id": str(message.id), "thread_id": str(message.channel.id),
+            "attachment_id": str(attachment.id), "form_page_id": form_page_id, "post_date": post_date,
+            "target": target.name,
+        })
+        for op_key, attachment in attachments
+    ])
+
+    asset_ids = await asyncio.gather(*(
+        process_attachment(attachment, post_date, target) for _, attachment in attachments
+    ))
+    asset_page_ids = [asset_id for asset_id in asset_ids if asset_id]
+    related = await notion_handler.relate_asset_to_form(form_page_id, asset_page_ids)
+    for (op_key, attachment), asset_id in zip(attachments, asset_ids):
+        if asset_id and related:
+            local_store.commit_operations([op_key], result=asset_id)
+        else:
+            local_store.fail_operations([op_key], f"添付ファイル {attachment.filename} の処理に失敗しました。")
+    return len(asset_page_ids) if related else 0
+
+
+async def mark_message_done(message_id: str, form_page_id: str, target: SyncTarget) -> bool:
+    """メッセージを処理済みとしてNotionとローカルインデックスに記録する"""
+    op_key = f"done:{message_id}"
+    local_store.plan_operations([
+        (op_key, "done", {"message_id": message_id, "form_page_id": form_page_id, "target": target.name})
+    ])
+    done_page_id = await notion_handler.add_done_message(
+        message_id, form_page_id, database_id=target.done_messages_database_id
+    )
+    if not done_page_id:
+        local_store.fail_operations([op_key], "DoneMessageの記録に失敗しました。")
+        return False
+    local_store.commit_operations([op_key], result=done_page_id)
+    local_store.add_done_message_ids([message_id], form_page_id)
+    return True
+
+
+async def finish_message(message, form_page_id: str, target: SyncTarget) -> int:
+    """添付ファイルを処理したうえで、メッセージを処理済みとして記録する。添付件数を返す"""
+    asset_count = 0
+    if message.attachments:
+        asset_count = await create_message_assets(message, form_page_id, target)
+    await mark_message_done(str(message.id), form_page_id, target)
+    metrics.inc("sync_messages_total", target=target.name)
+    target.coordinator.advance()
+    return asset_count
+
+
+def _index_messages(messages: list, form_page_id: str):
+    """Notionに書き込んだメッセージを全文検索の索引に登録する"""
+    local_store.index_documents([
+        {
+            "doc_key": f"message:{message.id}",
+            "thread_id": str(message.channel.id),
+            "guild_id": str(message.guild.id) if message.guild else None,
+            "page_id": form_page_id,
+            "thread_name": message.channel.name,
+            "author": message.author.display_name,
+            "content": "\n".join([message.content, *(a.filename for a in message.attachments)]),
+        }
+        for message in messages
+    ])
+
+
+async def finish_messages(messages: list, form_page_id: str, target: SyncTarget) -> int:
+    """ページへの書き込みが確定したメッセージを並行して後処理する。添付件数の合計を返す"""
+    _index_messages(messages, form_page_id)
+    asset_counts = await asyncio.gather(*(finish_message(message, form_page_id, target) for message in messages))
+    return sum(asset_counts)
+
+
+def _is_appended(message, form_page_id: str) -> bool:
+    """前回までの実行で、このメッセージの本文がページに追記済みかどうか"""
+    op = local_store.get_operation(f"append:{message.id}")
+    return bool(op and op["status"] == "committed" and op["payload"].get("form_page_id") == form_page_id)
+
+
+async def _create_form_page(thread, first_message, target: SyncTarget) -> str | None:
+    """最初のメッセージを本文にしてFormページを作成する。前回の実行が作成途中で止まっていた場合は二重に作成しない"""
+    thread_id = str(thread.id)
+    op_key = f"form:{thread_id}:{first_message.id}"
+    op = local_store.get_operation(op_key)
+    form_page_id = None
+    if op and op["status"] == "planned":
+        # 作成リクエストがNotionに届いていたかもしれないため、先に検索する
+        form_page_id = await notion_handler.query_form_page_by_thread_id(thread_id, database_id=target.form_database_id)
+    if not form_page_id:
+        local_store.plan_operations([(op_key, "form", {"thread_id": thread_id, "message_id": str(first_message.id)})])
+        form_page_id = await notion_handler.create_form_page(
+            thread_name=thread.name, thread_id=thread_id,
+            first_message_content=first_message.content,
+            post_date=first_message.created_at.astimezone(JST).isoformat(),
+            author_name=first_message.author.display_name,
+            database_id=target.form_database_id,
+        )
+    if not form_page_id:
+        local_store.fail_operations([op_key], "Formページの作成に失敗しました。")
+        return None
+    local_store.commit_operations([op_key], result=form_page_id)
+    # 最初のメッセージはページ作成と同時に書き込まれている
+    append_key = f"append:{first_message.id}"
+    local_store.plan_operations([(append_key, "append", {"message_id": str(first_message.id), "form_page_id": form_page_id})])
+    local_store.commit_operations([append_key])
+    return form_page_id
+
+
+async def sync_thread_messages(thread: discord.Thread, messages: list, target: SyncTarget) -> list[str]:
+    """1スレッド分の未処理メッセージをNotionに書き込み、結果のログを返す"""
+    summary_logs = []
+    thread_id = str(thread.id)
+    thread_name = thread.name
+    form_page_id = await get_form_page_id(thread_id, target)
+
+    if form_page_id:
+        # 前回の実行で追記まで終わっていたメッセージは、追記をやり直さずに後処理だけ行う
+        resumed_messages = [m for m in messages if _is_appended(m, form_page_id)]
+        if resumed_messages:
+            messages = [m for m in messages if m not in resumed_messages]
+            await finish_messages(resumed_messages, form_page_id, target)
+            summary_logs.append(f"スレッド「{thread_name}」の中断していた{len(resumed_messages)}件のメッセージの処理を再開しました。")
+
+    pending = [
+        (m, notion_handler.build_message_blocks(
+            m.content, m.author.display_name, m.created_at.astimezone(JST).strftime('%H:%M')
+        ))
+        for m in messages
+    ]
+
+    while pending:
+        if not form_page_id:
+            first_message = pending.pop(0)[0]
+            form_page_id = await _create_form_page(thread, first_message, target)
             if not form_page_id:
-                form_page_id = notion_handler.create_form_page(
-                    thread_name=thread_name, thread_id=thread_id,
-                    first_message_content=message.content, post_date=jst_time.isoformat(),
-                    author_name=message.author.display_name
-                )
-                if not form_page_id:
-                    summary_logs.append(f"スレッド「{thread_name}」のページ作成に失敗しました。")
-                    continue
-                summary_logs.append(f"スレッド「{thread_name}」を新規作成し、メッセージを追加しました。")
-            else:
-                notion_handler.append_text_to_page(
-                    page_id=form_page_id, content=message.content,
-                    author_name=message.author.display_name, post_time=jst_time.strftime('%H:%M')
-                )
-                summary_logs.append(f"スレッド「{thread_name}」に{message.author.display_name}のメッセージを追加しました。")
-
-            if message.attachments:
-                asset_page_ids = []
-                for attachment in message.attachments:
-                    file_url = await google_drive_handler.upload_to_drive(attachment)
-                    if file_url:
-                        asset_id = notion_handler.create_asset_page(
-                            file_name=attachment.filename, file_url=file_url,
-                            file_type=attachment.content_type or 'Unknown',
-                            file_size=attachment.size, post_date=jst_time.isoformat()
-                        )
-                        if asset_id:
-                            asset_page_ids.append(asset_id)
-                if asset_page_ids:
-                    notion_handler.relate_asset_to_form(form_page_id, asset_page_ids)
-                    summary_logs[-1] += f"（添付ファイル{len(asset_page_ids)}件を含む）"
-
-            notion_handler.add_done_message(str(message.id), form_page_id)
-
-        print("同期処理が正常に完了しました。")
-        return {"status": "SUCCESS", "summary": summary_logs}
+                summary_logs.append(f"スレッド「{thread_name}」のページ作成に失敗しました。")
+                return summary_logs
+            local_store.set_form_page_ids({thread_id: form_page_id}, database_id=target.form_database_id)
+            log = f"スレッド「{thread_name}」を新規作成し、メッセージを追加しました。"
+            asset_count = await finish_messages([first_message], form_page_id, target)
+            if asset_count:
+                log += f"（添付ファイル{asset_count}件を含む）"
+            summary_logs.append(log)
+            continue
+
+        batch = _take_append_batch(pending)
+        batch_messages = [m for m, _ in batch]
+        op_keys = [f"append:{m.id}" for m in batch_messages]
+        local_store.plan_operations([
+            (op_key, "append", {"message_id": str(m.id), "form_page_id": form_page_id})
+            for op_key, m in zip(op_keys, batch_messages)
+        ])
+        blocks = [block for _, message_blocks in batch for block in message_blocks]
+        if await notion_handler.append_blocks_to_page(form_page_id, blocks):
+            local_store.commit_operations(op_keys)
+            log = f"スレッド「{thread_name}」に{len(batch_messages)}件のメッセージを追加しました。"
+            asset_count = await finish_messages(batch_messages, form_page_id, target)
+            if asset_count:
+                log += f"（添付ファイル{asset_count}件を含む）"
+            summary_logs.append(log)
+        elif await notion_handler.is_page_archived(form_page_id):
+            # アーカイブ済みのページはキャッシュから外し、新しいページを作り直す
+            print(f"スレッド「{thread_name}」のページはアーカイブされているため、新規作成します。")
+            local_store.remove_form_page_id(thread_id)
+            form_page_id = None
+            pending[:0] = batch
+        else:
+            # 順序が崩れないよう、このスレッドの残りは次回の同期に回す
+            local_store.fail_operations(op_keys, "ページへの追記に失敗しました。")
+            summary_logs.append(f"スレッド「{thread_name}」へのメッセージ追加に失敗しました。")
+            return summary_logs
+
+    return summary_logs
+
+
+async def retry_failed_operations(target: SyncTarget) -> list[str]:
+    """アウトボックスに失敗として残っている、この同期対象の操作を再試行する
+
+    本文の追記やページ作成の失敗は、チェックポイントが進まないため次の同期でメッセージごと再取得される。
+    ここではメッセージの再取得だけでは戻ってこない、添付ファイルとDoneMessageの記録を再試行する。
+    """
+    summary_logs = []
+    for op in local_store.get_failed_operations(["done", "asset"], OUTBOX_MAX_ATTEMPTS):
+        payload = op["payload"]
+        if payload.get("target", sync_targets.DEFAULT_TARGET.name) != target.name:
+            continue
+        if op["kind"] == "done":
+            await mark_message_done(payload["message_id"], payload["form_page_id"], target)
+            continue
+
+        message = await _fetch_message(payload["thread_id"], payload["message_id"])
+        attachment = next((a for a in message.attachments if str(a.id) == payload["attachment_id"]), None) if message else None
+        if not attachment:
+            # 元のメッセージや添付ファイルが削除されている場合は再試行しない
+            local_store.commit_operations([op["op_key"]])
+            continue
+        asset_id = await process_attachment(attachment, payload["post_date"], target)
+        if asset_id and await notion_handler.relate_asset_to_form(payload["form_page_id"], [asset_id]):
+            local_store.commit_operations([op["op_key"]], result=asset_id)
+            summary_logs.append(f"前回失敗した添付ファイル {attachment.filename} の登録を再試行し、成功しました。")
+        else:
+            local_store.fail_operations([op["op_key"]], f"添付ファイル {attachment.filename} の再試行に失敗しました。")
+    return summary_logs
+
+
+async def sync_unprocessed_messages(messages: list, target: SyncTarget) -> list[str]:
+    """未処理メッセージをスレッドごとにまとめ、投稿順を保ったままバッチで追記する。結果のログを返す"""
+    thread_groups = {}
+    for message in messages:
+        if not isinstance(message.channel, discord.Thread):
+            continue
+        thread_groups.setdefault(message.channel.id, []).append(message)
+
+    async def sync_thread(thread_messages: list) -> list[str]:
+        async with target.worker_semaphore:
+            return await sync_thread_messages(thread_messages[0].channel, thread_messages, target)
+
+    # スレッド同士は独立しているため、同期対象の同時実行枠の範囲で並行して処理する
+    # (Notionへのリクエストは、notion_handler側で全ての同期対象に公平に割り当てる)
+    thread_logs = await asyncio.gather(*(sync_thread(thread_messages) for thread_messages in thread_groups.values()))
+    return [log for logs in thread_logs for log in logs]
+
+
+async def _fetch_message(thread_id: str, message_id: str) -> discord.Message | None:
+    """メッセージをDiscordから取り直す。削除済みならNoneを返す"""
+    try:
+        thread = bot.get_channel(int(thread_id)) or await bot.fetch_channel(int(thread_id))
+        return await thread.fetch_message(int(message_id))
+    except (discord.NotFound, discord.Forbidden):
+        return None
+
 
+@tasks.loop(seconds=REALTIME_FLUSH_INTERVAL)
+async def flush_pending_messages():
+    """書き込み待ちキューをまとめてNotionに書き込む"""
+    pending = local_store.get_pending_messages()
+    if not pending:
+        return
+    try:
+        messages = []
+        missing_ids = []
+        for message_id, thread_id, _ in pending:
+            message = _pending_messages.get(int(message_id)) or await _fetch_message(thread_id, message_id)
+            if message:
+                messages.append(message)
+            else:
+                missing_ids.append(message_id)
+
+        # 同期対象ごとに分け、定時同期の最中の同期対象は次回に回す
+        target_messages: dict[str, list] = {}
+        skipped_ids = []
+        for message in messages:
+            target = sync_targets.find_target_by_channel(getattr(message.channel, "parent_id", None))
+            if not target:
+                missing_ids.append(str(message.id))
+            elif target.write_lock.locked():
+                skipped_ids.append(str(message.id))
+            else:
+                target_messages.setdefault(target.name, []).append(message)
+        await asyncio.gather(*(
+            _flush_target_messages(sync_targets.get_target(name), target_message_list)
+            for name, target_message_list in target_messages.items()
+        ))
+
+        # 書き込めたもの・削除されたものはキューから外し、失敗したものは次回に再試行する
+        done_ids = local_store.load_done_message_ids()
+        finished_ids = missing_ids + [str(m.id) for m in messages if str(m.id) in done_ids]
+        failed = [
+            (message_id, attempts) for message_id, _, attempts in pending
+            if message_id not in finished_ids and message_id not in skipped_ids
+        ]
+        local_store.increment_pending_attempts([message_id for message_id, _ in failed])
+        # 何度も失敗するものは定時同期に任せる
+        finished_ids += [message_id for message_id, attempts in failed if attempts + 1 >= REALTIME_MAX_ATTEMPTS]
+        local_store.remove_pending_messages(finished_ids)
+        for message_id in finished_ids:
+            _pending_messages.pop(int(message_id), None)
     except Exception as e:
-        print(f"sync_messagesでエラーが発生しました: {e}")
-        import traceback
-        traceback.print_exc()
-        return {"status": "ERROR", "error_message": str(e)}
+        print(f"リアルタイム同期中にエラーが発生しました: {e}")
+
+
+async def _flush_target_messages(target: SyncTarget, messages: list):
+    """1つの同期対象の書き込み待ちメッセージをNotionに書き込む"""
+    rate_limiter.fair_share_key.set(target.name)
+    async with target.write_lock:
+        done_ids = local_store.load_done_message_ids()
+        unprocessed_messages = [m for m in messages if str(m.id) not in done_ids]
+        if unprocessed_messages:
+            for log in await sync_unprocessed_messages(unprocessed_messages, target):
+                print(f"[リアルタイム同期: {target.name}] {log}")
+
+
+async def sync_messages(target_name: str | None = None) -> dict:
+    """同期処理を行い、同期対象ごとの結果を辞書型で返す
+
+    target_nameを省略した場合は全ての同期対象を並行して同期する。既に実行中の同期対象は、その結果を待って返す。
+    """
+    targets = [sync_targets.get_target(target_name)] if target_name else sync_targets.SYNC_TARGETS
+    if None in targets:
+        return {"results": {target_name: {"status": "ERROR", "error_message": f"同期対象が見つかりません: {target_name}"}}}
+    before = metrics.snapshot()
+    results = await asyncio.gather(*(sync_target(target) for target in targets))
+    result = {
+        "results": {target.name: target_result for target, target_result in zip(targets, results)},
+        "metrics": metrics.summarize_since(before),
+    }
+    for line in result["metrics"]:
+        print(f"[計測] {line}")
+    return result
+
+
+async def sync_target(target: SyncTarget) -> dict:
+    """1つの同期対象を同期する。同じ同期対象の同期は同時に1つだけ実行される"""
+    return await target.coordinator.run(lambda: _run_sync_messages(target))
+
+
+async def _run_sync_messages(target: SyncTarget) -> dict:
+    """同期処理の本体。target.coordinator経由で同期対象ごとに1つずつ実行される"""
+    # このタスクから出るNotion/Driveへのリクエストを、同期対象の単位で公平に順番待ちさせる
+    rate_limiter.fair_share_key.set(target.name)
+    coordinator = target.coordinator
+    async with target.write_lock:
+        try:
+            print(f"[{target.name}] DiscordからNotionへのIDベース同期処理を開始します...")
+            summary_logs = []
+
+            coordinator.set_phase("Notionの同期状態を確認中")
+            with metrics.timer("sync_phase_seconds", phase="状態確認", target=target.name):
+                processed_message_ids = await refresh_done_message_ids(target)
+                await refresh_form_page_cache(target)
+                local_store.purge_committed_operations(OUTBOX_RETENTION)
+            coordinator.set_phase("失敗した書き込みを再試行中")
+            with metrics.timer("sync_phase_seconds", phase="再試行", target=target.name):
+                summary_logs.extend(await retry_failed_operations(target))
+
+            channel = bot.get_channel(target.channel_id)
+            if not channel:
+                return {"status": "ERROR", "error_message": f"チャンネルが見つかりません: {target.channel_id}"}
+
+            coordinator.set_phase("Discordからメッセージを取得中")
+            fetch_started_id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+            with metrics.timer("sync_phase_seconds", phase="Discord取得", target=target.name):
+                messages = await get_today_messages(channel, target)
+            if not messages:
+                print(f"[{target.name}] 同期対象の新しいメッセージはありません。")
+                advance_checkpoints(channel, messages, fetch_started_id)
+                return {"status": "NO_NEW_MESSAGES"}
+
+            unprocessed_messages = [m for m in messages if str(m.id) not in processed_message_ids]
+            print(f"[{target.name}] {len(unprocessed_messages)}件の未処理メッセージを処理します。")
+            if not unprocessed_messages:
+                advance_checkpoints(channel, messages, fetch_started_id)
+                return {"status": "SUCCESS", "summary": []}
+
+            coordinator.set_phase("Notionに書き込み中")
+            coordinator.add_total(len(unprocessed_messages))
+            with metrics.timer("sync_phase_seconds", phase="Notion書き込み", target=target.name):
+                summary_logs.extend(await sync_unprocessed_messages(unprocessed_messages, target))
+
+            advance_checkpoints(channel, messages, fetch_started_id)
+            failed_count = local_store.count_operations("failed")
+            if failed_count:
+                print(f"再試行待ちの書き込み操作が{failed_count}件あります。")
+            print(notion_handler.scheduler.format_stats())
+            print(f"[{target.name}] 同期処理が正常に完了しました。")
+            return {"status": "SUCCESS", "summary": summary_logs}
+
+        except Exception as e:
+            print(f"[{target.name}] sync_messagesでエラーが発生しました: {e}")
+            import traceback
+            traceback.print_exc()
+            return {"status": "ERROR", "error_message": str(e)}
 
 
 async def send_message_to_discord(content: str):
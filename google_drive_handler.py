@@ -1,12 +1,17 @@
-import io
+import asyncio
+import hashlib
 import os
+import random
+import threading
+from datetime import datetime, timedelta, timezone
 
-import requests
+import aiohttp
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+
+import local_store
+import metrics
 
 # 環境変数から情報を取得
 SCOPES = ['https://www.googleapis.com/auth/drive']
@@ -14,13 +19,34 @@ CLIENT_SECRETS_FILE = os.getenv("GOOGLE_DRIVE_CREDENTIALS")
 DRIVE_FOLDER_ID = os.getenv("GOOGLE_DRIVE_FOLDER_ID")
 TOKEN_FILE = "token.json"
 
-def get_drive_service():
-    """Google Drive APIサービスを取得する (OAuth 2.0 フロー)"""
+# 再開可能アップロードの設定
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+# チャンクサイズは256KiBの倍数である必要がある(256KiB未満を指定した場合は256KiBにする)。メモリ使用量はおおよそこのサイズに収まる
+UPLOAD_CHUNK_SIZE = max(
+    256 * 1024, int(os.getenv("DRIVE_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))) // (256 * 1024) * (256 * 1024)
+)
+DOWNLOAD_READ_SIZE = 64 * 1024
+DRIVE_UPLOAD_MAX_RETRIES = int(os.getenv("DRIVE_UPLOAD_MAX_RETRIES", "5"))
+# アップロードセッションURIの有効期限は1週間。余裕を持って6日で破棄する
+UPLOAD_SESSION_MAX_AGE = 6 * 24 * 60 * 60
+# Drive / Discord CDNへの同時接続数の上限
+DRIVE_MAX_CONNECTIONS = int(os.getenv("DRIVE_MAX_CONNECTIONS", "8"))
+# アクセストークンの有効期限がこの時間内に迫ったら、事前にリフレッシュする
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=5)
+
+# プロセス全体で共有する認証情報・HTTPセッション
+_credentials: Credentials | None = None
+_credentials_lock = threading.Lock()
+_http_session: aiohttp.ClientSession | None = None
+
+
+def _load_credentials() -> Credentials:
+    """Google Driveの認証情報を取得する (OAuth 2.0 フロー)"""
     creds = None
     # token.json があれば、そこから認証情報を読み込む
     if os.path.exists(TOKEN_FILE):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-    
+
     # 認証情報がない、または無効な場合
     if not creds or not creds.valid:
         # 認証情報が期限切れの場合、リフレッシュする
@@ -32,40 +58,254 @@ def get_drive_service():
             flow = InstalledAppFlow.from_client_secrets_file(
                 CLIENT_SECRETS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
-        
+
         # 新しい認証情報を token.json に保存する
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
-            print(f"認証情報を {TOKEN_FILE} に保存しました。")
+        _save_credentials(creds)
+        print(f"認証情報を {TOKEN_FILE} に保存しました。")
+
+    return creds
+
+
+def _save_credentials(creds: Credentials):
+    with open(TOKEN_FILE, 'w') as token:
+        token.write(creds.to_json())
+
 
-    return build('drive', 'v3', credentials=creds)
+def _needs_refresh(creds: Credentials) -> bool:
+    if not creds.valid:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-authのexpiryはタイムゾーンなしのUTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry - now < CREDENTIAL_REFRESH_MARGIN
 
-async def upload_to_drive(attachment) -> str:
-    """ファイルをGDriveにアップロードし永続URLを返す"""
-    drive_service = get_drive_service()
 
-    # Discord CDNからダウンロード
-    response = requests.get(attachment.url)
-    file_content = io.BytesIO(response.content)
+def _get_credentials() -> Credentials:
+    """共有の認証情報を返す。初回のみtoken.jsonを読み込み、期限が迫っていればリフレッシュする"""
+    global _credentials
+    with _credentials_lock:
+        if _credentials is None:
+            _credentials = _load_credentials()
+        if _needs_refresh(_credentials) and _credentials.refresh_token:
+            _credentials.refresh(Request())
+            _save_credentials(_credentials)
+        return _credentials
 
-    # GDriveにアップロード
+
+async def _get_access_token() -> str:
+    creds = _credentials
+    if creds is not None and not _needs_refresh(creds):
+        return creds.token
+    # トークンのリフレッシュはブロッキングな通信を伴うため、別スレッドで実行する
+    creds = await asyncio.to_thread(_get_credentials)
+    return creds.token
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """アップロード間で共有する、接続プール付きのHTTPセッションを返す"""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=DRIVE_MAX_CONNECTIONS),
+            # 大きなファイルの転送が途中で打ち切られないよう、全体のタイムアウトは設けない
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120),
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """共有HTTPセッションを閉じる (アプリケーション終了時に呼び出す)"""
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+
+
+class UploadSessionExpired(Exception):
+    """再開可能アップロードのセッションが失効している"""
+
+
+async def _start_upload_session(session: aiohttp.ClientSession, token: str, attachment, folder_id: str | None = None) -> str:
+    """再開可能アップロードのセッションを開始し、セッションURIを返す"""
     file_metadata = {
         'name': attachment.filename,
-        'parents': [DRIVE_FOLDER_ID]
+        'parents': [folder_id or DRIVE_FOLDER_ID]
+    }
+    headers = {
+        'Authorization': f'Bearer {token}',
+        'X-Upload-Content-Length': str(attachment.size),
     }
-    media = MediaIoBaseUpload(file_content, mimetype=attachment.content_type)
-
-    file = drive_service.files().create(
-        body=file_metadata,
-        media_body=media,
-        fields='id, webViewLink'
-    ).execute()
-
-    # 公開権限設定は不要（自分のドライブ内のファイルなので、リンクを知っていれば見れる）
-    # もし必要であれば、以下のコメントを解除
-    # drive_service.permissions().create(
-    #     fileId=file['id'],
-    #     body={'type': 'anyone', 'role': 'reader'}
-    # ).execute()
-
-    return file['webViewLink']
\ No newline at end of file
+    if attachment.content_type:
+        headers['X-Upload-Content-Type'] = attachment.content_type
+    params = {'uploadType': 'resumable', 'fields': 'id, webViewLink'}
+    with metrics.request_timer("Drive", "start_upload"):
+        async with session.post(DRIVE_UPLOAD_URL, params=params, headers=headers, json=file_metadata) as response:
+            response.raise_for_status()
+            return response.headers['Location']
+
+
+def _committed_offset(response: aiohttp.ClientResponse) -> int:
+    """308応答のRangeヘッダーから、サーバーが受け取り済みのバイト数を求める"""
+    range_header = response.headers.get('Range')
+    if not range_header:
+        return 0
+    return int(range_header.split('-')[-1]) + 1
+
+
+async def _query_upload_status(session: aiohttp.ClientSession, token: str, session_uri: str, total: int):
+    """セッションの進捗を問い合わせる。完了済みならファイル情報(dict)、途中ならオフセット(int)を返す"""
+    headers = {'Authorization': f'Bearer {token}', 'Content-Range': f'bytes */{total}'}
+    with metrics.request_timer("Drive", "query_upload_status"):
+        async with session.put(session_uri, headers=headers) as response:
+            if response.status == 308:
+                return _committed_offset(response)
+            if response.status in (404, 410):
+                raise UploadSessionExpired(session_uri)
+            response.raise_for_status()
+            return await response.json()
+
+
+async def _put_chunk(session: aiohttp.ClientSession, token: str, session_uri: str, data: bytes, offset: int, total: int):
+    """チャンクを1つ送信する。完了したらファイル情報(dict)、途中なら受け取り済みオフセット(int)を返す"""
+    headers = {'Authorization': f'Bearer {token}'}
+    if data:
+        headers['Content-Range'] = f'bytes {offset}-{offset + len(data) - 1}/{total}'
+    else:
+        headers['Content-Range'] = f'bytes */{total}'
+    with metrics.request_timer("Drive", "put_chunk"):
+        async with session.put(session_uri, headers=headers, data=data) as response:
+            metrics.inc("bytes_total", len(data), service="Drive", direction="sent")
+            if response.status == 308:
+                return _committed_offset(response)
+            if response.status in (404, 410):
+                raise UploadSessionExpired(session_uri)
+            response.raise_for_status()
+            return await response.json()
+
+
+async def _hash_remote_file(session: aiohttp.ClientSession, attachment) -> str:
+    """Discord CDNからファイルをストリーミングで読み込み、SHA-256を計算する"""
+    digest = hashlib.sha256()
+    with metrics.request_timer("Discord", "download_attachment"):
+        async with session.get(attachment.url) as download:
+            download.raise_for_status()
+            async for data in download.content.iter_chunked(DOWNLOAD_READ_SIZE):
+                digest.update(data)
+                metrics.inc("bytes_total", len(data), service="Discord", direction="received")
+    return digest.hexdigest()
+
+
+async def _stream_upload(session: aiohttp.ClientSession, token: str, session_uri: str, attachment, offset: int):
+    """Discord CDNからストリーミングで読み込み、offset以降をチャンク単位でDriveに送る。(ファイル情報, SHA-256)を返す
+
+    ハッシュを計算するため、再開時も先頭から読み込み、送信済みの部分は読み捨てる。
+    """
+    total = attachment.size
+    digest = hashlib.sha256()
+    if total == 0:
+        result = await _put_chunk(session, token, session_uri, b'', 0, 0)
+        if isinstance(result, dict):
+            return result, digest.hexdigest()
+        raise aiohttp.ClientPayloadError("空ファイルのアップロードが完了しませんでした。")
+
+    async with session.get(attachment.url) as download:
+        download.raise_for_status()
+        skip = offset
+        buffer = bytearray()
+        async for data in download.content.iter_chunked(DOWNLOAD_READ_SIZE):
+            digest.update(data)
+            metrics.inc("bytes_total", len(data), service="Discord", direction="received")
+            if skip:
+                dropped = min(skip, len(data))
+                data = data[dropped:]
+                skip -= dropped
+            buffer.extend(data)
+            while len(buffer) >= UPLOAD_CHUNK_SIZE:
+                result = await _put_chunk(session, token, session_uri, bytes(buffer[:UPLOAD_CHUNK_SIZE]), offset, total)
+                if isinstance(result, dict):
+                    return result, digest.hexdigest()
+                # サーバーが受け取った分だけバッファから取り除く
+                del buffer[:result - offset]
+                offset = result
+
+        while True:
+            result = await _put_chunk(session, token, session_uri, bytes(buffer), offset, total)
+            if isinstance(result, dict):
+                return result, digest.hexdigest()
+            if result <= offset:
+                raise aiohttp.ClientPayloadError("アップロードが進まなくなりました。")
+            del buffer[:result - offset]
+            offset = result
+
+
+async def find_uploaded_file(attachment) -> dict | None:
+    """同じ内容のファイルが既にアップロード済みであれば、その記録(file_url, asset_page_id等)を返す
+
+    添付ファイルIDが記録済みならそれを使い、同じサイズのファイルがある場合だけハッシュを計算して照合する。
+    """
+    record = local_store.find_attachment_by_id(str(attachment.id))
+    if record or not local_store.has_attachment_of_size(attachment.size):
+        return record
+    try:
+        sha256 = await _hash_remote_file(_get_http_session(), attachment)
+    except Exception as e:
+        print(f"{attachment.filename} のハッシュ計算中にエラー: {e}")
+        return None
+    record = local_store.find_attachment_by_sha256(sha256)
+    if record:
+        local_store.record_attachment(str(attachment.id), attachment.filename, attachment.size, sha256)
+    return record
+
+
+async def upload_to_drive(attachment, folder_id: str | None = None) -> str | None:
+    """ファイルをGDriveのフォルダ(省略時はGOOGLE_DRIVE_FOLDER_ID)にストリーミングでアップロードし永続URLを返す
+
+    中断した場合は続きから再開する。
+    """
+    attachment_id = str(attachment.id)
+    session = _get_http_session()
+    try:
+        for attempt in range(DRIVE_UPLOAD_MAX_RETRIES + 1):
+            token = await _get_access_token()
+            session_uri = local_store.get_upload_session(attachment_id, UPLOAD_SESSION_MAX_AGE)
+            try:
+                offset = 0
+                if session_uri:
+                    status = await _query_upload_status(session, token, session_uri, attachment.size)
+                    if isinstance(status, dict):
+                        file = status
+                        sha256 = await _hash_remote_file(session, attachment)
+                        break
+                    offset = status
+                    print(f"{attachment.filename} のアップロードを {offset} バイト目から再開します。")
+                else:
+                    session_uri = await _start_upload_session(session, token, attachment, folder_id)
+                    local_store.set_upload_session(attachment_id, session_uri)
+                file, sha256 = await _stream_upload(session, token, session_uri, attachment, offset)
+                break
+            except UploadSessionExpired:
+                local_store.remove_upload_session(attachment_id)
+                if attempt >= DRIVE_UPLOAD_MAX_RETRIES:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 認証切れ・レート制限・サーバーエラー・通信断以外は再試行しても成功しない
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status not in (401, 408, 429):
+                    raise
+                if isinstance(e, aiohttp.ClientResponseError) and e.status == 401 and _credentials is not None:
+                    # トークンが失効している場合は、次の試行でリフレッシュさせる
+                    _credentials.token = None
+                if attempt >= DRIVE_UPLOAD_MAX_RETRIES:
+                    raise
+                metrics.inc("retries_total", service="Drive")
+                if isinstance(e, aiohttp.ClientResponseError) and e.status == 429:
+                    metrics.inc("rate_limited_total", service="Drive")
+                delay = random.uniform(0, min(30, 2 ** attempt))
+                print(f"{attachment.filename} のアップロードが中断しました。{delay:.1f}秒後に再開します: {e}")
+                await asyncio.sleep(delay)
+
+        local_store.remove_upload_session(attachment_id)
+        local_store.record_attachment(attachment_id, attachment.filename, attachment.size, sha256, file['webViewLink'])
+        # 公開権限設定は不要（自分のドライブ内のファイルなので、リンクを知っていれば見れる）
+        return file['webViewLink']
+    except Exception as e:
+        print(f"{attachment.filename} のGoogle Driveへのアップロード中にエラー: {e}")
+        return None
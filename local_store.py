@@ -0,0 +1,639 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+# ローカル永続化ストア (SQLite) のファイルパス
+LOCAL_STORE_PATH = os.getenv("LOCAL_STORE_PATH", "noticord.db")
+
+_conn: sqlite3.Connection | None = None
+_lock = threading.Lock()
+
+# 処理済みメッセージIDのメモリ上のコピー (起動後に一度だけDBから読み込む)
+_done_message_ids: Set[str] | None = None
+
+
+def _get_conn() -> sqlite3.Connection:
+    """SQLite接続を取得する。初回呼び出し時にテーブルを作成する"""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(LOCAL_STORE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS done_messages (
+                message_id TEXT PRIMARY KEY,
+                form_page_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS form_pages (
+                thread_id TEXT PRIMARY KEY,
+                page_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS drive_upload_sessions (
+                attachment_id TEXT PRIMARY KEY,
+                session_uri TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS attachment_files (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                file_url TEXT NOT NULL,
+                asset_page_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS attachment_ids (
+                attachment_id TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                filename TEXT,
+                size INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS attachment_files_size ON attachment_files (size);
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                scope_id TEXT PRIMARY KEY,
+                last_message_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pending_messages (
+                message_id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS outbox (
+                op_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status);
+            CREATE TABLE IF NOT EXISTS page_summaries (
+                page_id TEXT PRIMARY KEY,
+                last_block_id TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS block_children (
+                block_id TEXT PRIMARY KEY,
+                last_edited_time TEXT NOT NULL,
+                children TEXT NOT NULL,
+                fetched_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                cache_key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                last_used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used_at);
+            CREATE TABLE IF NOT EXISTS search_documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                doc_key TEXT NOT NULL UNIQUE,
+                thread_id TEXT,
+                guild_id TEXT,
+                page_id TEXT,
+                thread_name TEXT NOT NULL DEFAULT '',
+                author TEXT NOT NULL DEFAULT '',
+                content TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS search_documents_page ON search_documents (page_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                thread_name, author, content,
+                content='search_documents', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS search_documents_ai AFTER INSERT ON search_documents BEGIN
+                INSERT INTO search_index (rowid, thread_name, author, content)
+                VALUES (new.id, new.thread_name, new.author, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_documents_ad AFTER DELETE ON search_documents BEGIN
+                INSERT INTO search_index (search_index, rowid, thread_name, author, content)
+                VALUES ('delete', old.id, old.thread_name, old.author, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS search_documents_au AFTER UPDATE ON search_documents BEGIN
+                INSERT INTO search_index (search_index, rowid, thread_name, author, content)
+                VALUES ('delete', old.id, old.thread_name, old.author, old.content);
+                INSERT INTO search_index (rowid, thread_name, author, content)
+                VALUES (new.id, new.thread_name, new.author, new.content);
+            END;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        # 同期対象を複数にした際に追加した列 (既存のDBには列を足す)
+        _add_column_if_missing(_conn, "form_pages", "database_id", "TEXT")
+        _add_column_if_missing(_conn, "attachment_files", "assets_database_id", "TEXT")
+        # ブロックのキャッシュに有効期限を設けた際に追加した列 (既存の行は期限切れとして扱われる)
+        _add_column_if_missing(_conn, "block_children", "fetched_at", "REAL NOT NULL DEFAULT 0")
+        _conn.execute("CREATE INDEX IF NOT EXISTS block_children_fetched_at ON block_children (fetched_at)")
+    return _conn
+
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, declaration: str):
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        conn.commit()
+
+
+def get_meta(key: str) -> str | None:
+    with _lock:
+        row = _get_conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(key: str, value: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+        conn.commit()
+
+
+# --- 処理済みメッセージのインデックス ---
+def load_done_message_ids() -> Set[str]:
+    """処理済みメッセージIDの集合を返す。DBからの読み込みはプロセス内で一度だけ行う"""
+    global _done_message_ids
+    if _done_message_ids is None:
+        with _lock:
+            rows = _get_conn().execute("SELECT message_id FROM done_messages").fetchall()
+        _done_message_ids = {row[0] for row in rows}
+        print(f"ローカルインデックスから{len(_done_message_ids)}件の処理済みメッセージIDを読み込みました。")
+    return _done_message_ids
+
+
+def add_done_message_ids(message_ids, form_page_id: str | None = None):
+    """処理済みメッセージIDをインデックスに追加する"""
+    message_ids = [m for m in message_ids if m]
+    if not message_ids:
+        return
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "INSERT OR IGNORE INTO done_messages (message_id, form_page_id) VALUES (?, ?)",
+            [(m, form_page_id) for m in message_ids],
+        )
+        conn.commit()
+    load_done_message_ids().update(message_ids)
+
+
+# --- スレッドID → FormページIDのキャッシュ ---
+def get_form_page_id(thread_id: str) -> str | None:
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT page_id FROM form_pages WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def set_form_page_ids(mapping: Dict[str, str], replace: bool = False, database_id: str | None = None):
+    """スレッドID → FormページIDの対応を保存する
+
+    replace=Trueの場合は、同じFormデータベース(database_id)の既存の対応を全て置き換える。
+    """
+    with _lock:
+        conn = _get_conn()
+        if replace:
+            conn.execute("DELETE FROM form_pages WHERE database_id IS ?", (database_id,))
+        conn.executemany(
+            "INSERT INTO form_pages (thread_id, page_id, database_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET page_id = excluded.page_id, "
+            "database_id = COALESCE(excluded.database_id, form_pages.database_id)",
+            [(thread_id, page_id, database_id) for thread_id, page_id in mapping.items()],
+        )
+        conn.commit()
+
+
+def remove_form_page_id(thread_id: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute("DELETE FROM form_pages WHERE thread_id = ?", (thread_id,))
+        conn.commit()
+
+
+# --- Google Driveの再開可能アップロードのセッション ---
+def get_upload_session(attachment_id: str, max_age_seconds: float) -> str | None:
+    """保存済みのアップロードセッションURIを返す。期限切れのものは破棄する"""
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute(
+            "SELECT session_uri, created_at FROM drive_upload_sessions WHERE attachment_id = ?",
+            (attachment_id,),
+        ).fetchone()
+        if row and time.time() - row[1] > max_age_seconds:
+            conn.execute("DELETE FROM drive_upload_sessions WHERE attachment_id = ?", (attachment_id,))
+            conn.commit()
+            row = None
+    return row[0] if row else None
+
+
+def set_upload_session(attachment_id: str, session_uri: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO drive_upload_sessions (attachment_id, session_uri, created_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(attachment_id) DO UPDATE SET session_uri = excluded.session_uri, created_at = excluded.created_at",
+            (attachment_id, session_uri, time.time()),
+        )
+        conn.commit()
+
+
+def remove_upload_session(attachment_id: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute("DELETE FROM drive_upload_sessions WHERE attachment_id = ?", (attachment_id,))
+        conn.commit()
+
+
+# --- 添付ファイルの内容ハッシュによる重複排除 ---
+def _attachment_row(row) -> Dict[str, Any] | None:
+    if not row:
+        return None
+    return {
+        "sha256": row[0], "size": row[1], "file_url": row[2], "asset_page_id": row[3], "assets_database_id": row[4],
+    }
+
+
+def find_attachment_by_id(attachment_id: str) -> Dict[str, Any] | None:
+    """Discordの添付ファイルIDから、記録済みのファイル情報を返す"""
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT f.sha256, f.size, f.file_url, f.asset_page_id, f.assets_database_id FROM attachment_ids i "
+            "JOIN attachment_files f ON f.sha256 = i.sha256 WHERE i.attachment_id = ?",
+            (attachment_id,),
+        ).fetchone()
+    return _attachment_row(row)
+
+
+def has_attachment_of_size(size: int) -> bool:
+    """同じサイズのファイルが記録されているか (ハッシュ計算が必要かどうかの事前判定)"""
+    with _lock:
+        row = _get_conn().execute("SELECT 1 FROM attachment_files WHERE size = ? LIMIT 1", (size,)).fetchone()
+    return row is not None
+
+
+def find_attachment_by_sha256(sha256: str) -> Dict[str, Any] | None:
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT sha256, size, file_url, asset_page_id, assets_database_id FROM attachment_files WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+    return _attachment_row(row)
+
+
+def record_attachment(attachment_id: str, filename: str, size: int, sha256: str, file_url: str | None = None):
+    """添付ファイルIDとハッシュの対応を記録する。file_urlを指定した場合はファイル本体の情報も登録する"""
+    with _lock:
+        conn = _get_conn()
+        if file_url:
+            conn.execute(
+                "INSERT OR IGNORE INTO attachment_files (sha256, size, file_url) VALUES (?, ?, ?)",
+                (sha256, size, file_url),
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO attachment_ids (attachment_id, sha256, filename, size) VALUES (?, ?, ?, ?)",
+            (attachment_id, sha256, filename, size),
+        )
+        conn.commit()
+
+
+def set_attachment_asset_page(attachment_id: str, asset_page_id: str, assets_database_id: str | None = None):
+    """添付ファイルに対応するAssetページのIDと、そのページがあるAssetsデータベースのIDを記録する"""
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "UPDATE attachment_files SET asset_page_id = ?, assets_database_id = ? "
+            "WHERE sha256 = (SELECT sha256 FROM attachment_ids WHERE attachment_id = ?)",
+            (asset_page_id, assets_database_id, attachment_id),
+        )
+        conn.commit()
+
+
+# --- Discordのチャンネル・スレッドごとの同期位置 ---
+def get_checkpoint(scope_id: str) -> int | None:
+    """チャンネルまたはスレッドについて、同期済みの最後のメッセージID(スノーフレーク)を返す"""
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT last_message_id FROM checkpoints WHERE scope_id = ?", (scope_id,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def set_checkpoints(checkpoints: Dict[str, int]):
+    """同期位置を更新する。既存の値より古い位置には戻さない"""
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "INSERT INTO checkpoints (scope_id, last_message_id) VALUES (?, ?) "
+            "ON CONFLICT(scope_id) DO UPDATE SET last_message_id = MAX(last_message_id, excluded.last_message_id)",
+            list(checkpoints.items()),
+        )
+        conn.commit()
+
+
+# --- リアルタイム同期の書き込み待ちキュー ---
+def enqueue_pending_message(message_id: str, thread_id: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT OR IGNORE INTO pending_messages (message_id, thread_id, enqueued_at) VALUES (?, ?, ?)",
+            (message_id, thread_id, time.time()),
+        )
+        conn.commit()
+
+
+def get_pending_messages() -> List[Tuple[str, str, int]]:
+    """書き込み待ちのメッセージを (メッセージID, スレッドID, 試行回数) の形で古い順に返す"""
+    with _lock:
+        return _get_conn().execute(
+            "SELECT message_id, thread_id, attempts FROM pending_messages ORDER BY enqueued_at"
+        ).fetchall()
+
+
+def remove_pending_messages(message_ids):
+    with _lock:
+        conn = _get_conn()
+        conn.executemany("DELETE FROM pending_messages WHERE message_id = ?", [(m,) for m in message_ids])
+        conn.commit()
+
+
+def increment_pending_attempts(message_ids):
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "UPDATE pending_messages SET attempts = attempts + 1 WHERE message_id = ?", [(m,) for m in message_ids]
+        )
+        conn.commit()
+
+
+# --- Notion/Driveへの書き込み操作の先行書き込みログ (アウトボックス) ---
+# 各操作は冪等性キーで識別し、planned(実行前) → committed(完了) / failed(失敗) と状態を遷移させる。
+# 再起動後に planned のまま残っている操作は、実行途中で停止した可能性があるものとして扱う。
+def _operation_row(row) -> Dict[str, Any] | None:
+    if not row:
+        return None
+    return {
+        "op_key": row[0],
+        "kind": row[1],
+        "payload": json.loads(row[2]),
+        "status": row[3],
+        "result": row[4],
+        "attempts": row[5],
+        "last_error": row[6],
+    }
+
+
+def get_operation(op_key: str) -> Dict[str, Any] | None:
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT op_key, kind, payload, status, result, attempts, last_error FROM outbox WHERE op_key = ?",
+            (op_key,),
+        ).fetchone()
+    return _operation_row(row)
+
+
+def plan_operations(operations: List[Tuple[str, str, Dict[str, Any]]]):
+    """(冪等性キー, 種別, 内容) の操作を実行前に記録する。完了済みの操作は変更しない"""
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "INSERT INTO outbox (op_key, kind, payload, status, updated_at) VALUES (?, ?, ?, 'planned', ?) "
+            "ON CONFLICT(op_key) DO UPDATE SET payload = excluded.payload, status = 'planned', "
+            "updated_at = excluded.updated_at WHERE outbox.status != 'committed'",
+            [(key, kind, json.dumps(payload), time.time()) for key, kind, payload in operations],
+        )
+        conn.commit()
+
+
+def commit_operations(op_keys, result: str | None = None):
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "UPDATE outbox SET status = 'committed', result = ?, last_error = NULL, updated_at = ? WHERE op_key = ?",
+            [(result, time.time(), key) for key in op_keys],
+        )
+        conn.commit()
+
+
+def fail_operations(op_keys, error: str):
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ?, updated_at = ? "
+            "WHERE op_key = ? AND status != 'committed'",
+            [(error, time.time(), key) for key in op_keys],
+        )
+        conn.commit()
+
+
+def get_failed_operations(kinds, max_attempts: int) -> List[Dict[str, Any]]:
+    """再試行対象の失敗した操作を古い順に返す"""
+    kinds = list(kinds)
+    placeholders = ", ".join("?" for _ in kinds)
+    with _lock:
+        rows = _get_conn().execute(
+            "SELECT op_key, kind, payload, status, result, attempts, last_error FROM outbox "
+            f"WHERE status = 'failed' AND attempts < ? AND kind IN ({placeholders}) ORDER BY updated_at",
+            (max_attempts, *kinds),
+        ).fetchall()
+    return [_operation_row(row) for row in rows]
+
+
+def count_operations(status: str) -> int:
+    with _lock:
+        return _get_conn().execute("SELECT COUNT(*) FROM outbox WHERE status = ?", (status,)).fetchone()[0]
+
+
+def purge_committed_operations(older_than_seconds: float):
+    """完了から一定期間が過ぎた操作の記録を削除する"""
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "DELETE FROM outbox WHERE status = 'committed' AND updated_at < ?",
+            (time.time() - older_than_seconds,),
+        )
+        conn.commit()
+
+
+# --- ページごとの要約の状態 (差分要約用) ---
+def get_page_summary(page_id: str) -> Tuple[str, str] | None:
+    """前回要約したときのページ末尾のブロックIDと要約を返す"""
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT last_block_id, summary FROM page_summaries WHERE page_id = ?", (page_id,)
+        ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def set_page_summary(page_id: str, last_block_id: str, summary: str):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO page_summaries (page_id, last_block_id, summary, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(page_id) DO UPDATE SET last_block_id = excluded.last_block_id, "
+            "summary = excluded.summary, updated_at = excluded.updated_at",
+            (page_id, last_block_id, summary, time.time()),
+        )
+        conn.commit()
+
+
+# --- Notionブロックの子ブロックのキャッシュ ---
+# ブロックのlast_edited_timeが保存時と同じで、保存からmax_age秒以内であれば、その子孫のブロックは変わっていないものとして再利用する
+# (子孫だけが編集されても親のlast_edited_timeは変わらないため、有効期限で古い内容を使い続ける時間を抑える)
+def get_block_children(block_id: str, last_edited_time: str, max_age: float) -> List[Dict[str, Any]] | None:
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT children FROM block_children WHERE block_id = ? AND last_edited_time = ? AND fetched_at >= ?",
+            (block_id, last_edited_time, time.time() - max_age),
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def set_block_children(block_id: str, last_edited_time: str, children: List[Dict[str, Any]], max_entries: int):
+    """子孫を含めた子ブロックの一覧を保存し、件数が上限を超えたら最も古く保存したものから削除する"""
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO block_children (block_id, last_edited_time, children, fetched_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(block_id) DO UPDATE SET last_edited_time = excluded.last_edited_time, "
+            "children = excluded.children, fetched_at = excluded.fetched_at",
+            (block_id, last_edited_time, json.dumps(children, ensure_ascii=False), time.time()),
+        )
+        conn.execute(
+            "DELETE FROM block_children WHERE block_id IN ("
+            "SELECT block_id FROM block_children ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        )
+        conn.commit()
+
+
+# --- LLMの応答キャッシュ ---
+# プロンプトなどから計算したハッシュをキーに応答を保存し、件数が上限を超えたら最も長く使われていないものから削除する (LRU)
+def get_llm_cache(cache_key: str) -> str | None:
+    with _lock:
+        conn = _get_conn()
+        row = conn.execute("SELECT response FROM llm_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row:
+            conn.execute("UPDATE llm_cache SET last_used_at = ? WHERE cache_key = ?", (time.time(), cache_key))
+            conn.commit()
+    return row[0] if row else None
+
+
+def set_llm_cache(cache_key: str, response: str, max_entries: int):
+    with _lock:
+        conn = _get_conn()
+        conn.execute(
+            "INSERT INTO llm_cache (cache_key, response, last_used_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(cache_key) DO UPDATE SET response = excluded.response, last_used_at = excluded.last_used_at",
+            (cache_key, response, time.time()),
+        )
+        conn.execute(
+            "DELETE FROM llm_cache WHERE cache_key IN ("
+            "SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+            (max_entries,),
+        )
+        conn.commit()
+
+
+# --- 全文検索インデックス ---
+# 同期したメッセージとAIの要約をFTS5 (trigramトークナイザ) で索引付けする。
+# trigramは3文字未満の語を検索できないため、短い語はLIKEで絞り込む。
+def _normalize_page_id(page_id: str | None) -> str | None:
+    return page_id.replace("-", "") if page_id else None
+
+
+def index_documents(documents: List[Dict[str, Any]]):
+    """doc_key, thread_id, guild_id, page_id, thread_name, author, content を持つ辞書の列を索引に登録する (同じdoc_keyは上書き)"""
+    with _lock:
+        conn = _get_conn()
+        conn.executemany(
+            "INSERT INTO search_documents (doc_key, thread_id, guild_id, page_id, thread_name, author, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(doc_key) DO UPDATE SET thread_id = excluded.thread_id, guild_id = excluded.guild_id, "
+            "page_id = excluded.page_id, thread_name = excluded.thread_name, author = excluded.author, "
+            "content = excluded.content",
+            [
+                (
+                    doc["doc_key"], doc.get("thread_id"), doc.get("guild_id"), _normalize_page_id(doc.get("page_id")),
+                    doc.get("thread_name") or "", doc.get("author") or "", doc.get("content") or "",
+                )
+                for doc in documents
+            ],
+        )
+        conn.commit()
+
+
+def index_summary(page_id: str, summary: str):
+    """ページに追記したAIの要約を索引に登録する。スレッドの情報は同じページのメッセージから引き継ぐ"""
+    page_id = _normalize_page_id(page_id)
+    with _lock:
+        row = _get_conn().execute(
+            "SELECT thread_id, guild_id, thread_name FROM search_documents WHERE page_id = ? LIMIT 1", (page_id,)
+        ).fetchone()
+    thread_id, guild_id, thread_name = row if row else (None, None, "")
+    index_documents([{
+        "doc_key": f"summary:{page_id}",
+        "thread_id": thread_id,
+        "guild_id": guild_id,
+        "page_id": page_id,
+        "thread_name": thread_name,
+        "author": "AIによる要約",
+        "content": summary,
+    }])
+
+
+def search_documents(query: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """検索語を全て含む文書をスコア順に探し、スレッド(ページ)ごとに最も一致したものを返す"""
+    terms = query.split()
+    if not terms:
+        return []
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+
+    conditions = []
+    params: List[Any] = []
+    for term in short_terms:
+        pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append("(d.thread_name LIKE ? ESCAPE '\\' OR d.author LIKE ? ESCAPE '\\' OR d.content LIKE ? ESCAPE '\\')")
+        params += [pattern, pattern, pattern]
+
+    columns = "d.thread_id, d.guild_id, d.page_id, d.thread_name, d.author, d.content"
+    if long_terms:
+        match = " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        # スレッド名・投稿者・本文の順に重みを付ける
+        sql = (
+            f"SELECT {columns} FROM search_index JOIN search_documents d ON d.id = search_index.rowid "
+            f"WHERE search_index MATCH ? {''.join(' AND ' + c for c in conditions)} "
+            "ORDER BY bm25(search_index, 5.0, 2.0, 1.0) LIMIT ?"
+        )
+        params = [match, *params]
+    else:
+        sql = f"SELECT {columns} FROM search_documents d WHERE {' AND '.join(conditions)} ORDER BY d.id DESC LIMIT ?"
+    params.append(limit * 10)
+
+    with _lock:
+        rows = _get_conn().execute(sql, params).fetchall()
+
+    results = []
+    seen = set()
+    for thread_id, guild_id, page_id, thread_name, author, content in rows:
+        group = thread_id or page_id
+        if group in seen:
+            continue
+        seen.add(group)
+        results.append({
+            "thread_id": thread_id,
+            "guild_id": guild_id,
+            "page_id": page_id,
+            "thread_name": thread_name,
+            "author": author,
+            "content": content,
+        })
+        if len(results) >= limit:
+            break
+    return results
@@ -7,23 +7,37 @@ load_dotenv()
 
 # 環境変数を読み込んだ後にモジュールをインポートする
 import discord_handler
+import google_drive_handler
+import metrics
+import sync_targets
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 async def main():
     """スケジューラとDiscord Botをセットアップして実行する"""
-    # スケジューラの初期化とジョブの追加
+    # スケジューラの初期化と、同期対象ごとのジョブの追加
+    # (リアルタイム同期を有効にした場合も、取りこぼしを補う整合性チェックとして定時同期を動かす)
     scheduler = AsyncIOScheduler(timezone='Asia/Tokyo')
-    scheduler.add_job(
-        discord_handler.sync_messages, 
-        CronTrigger(hour='12,0', minute='0', second='0')
-    )
+    for target in sync_targets.SYNC_TARGETS:
+        scheduler.add_job(
+            discord_handler.sync_messages,
+            CronTrigger(**target.schedule),
+            args=[target.name],
+            id=f"sync:{target.name}",
+        )
     scheduler.start()
     print("スケジューラを開始しました。")
 
+    # メトリクスの公開 (METRICS_PORTを設定した場合のみ)
+    await metrics.start_http_server()
+
     # Discord Botの起動
     # client.start()は非同期にBotを起動する
-    await discord_handler.bot.start(discord_handler.DISCORD_BOT_TOKEN)
+    try:
+        await discord_handler.bot.start(discord_handler.DISCORD_BOT_TOKEN)
+    finally:
+        await google_drive_handler.close_http_session()
+        await metrics.stop_http_server()
 
 if __name__ == "__main__":
     print("アプリケーションを起動します...")
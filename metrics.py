@@ -0,0 +1,215 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple
+
+from aiohttp import web
+
+# メトリクスを公開するHTTPポート (未設定の場合は公開しない)
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+PREFIX = "noticord_"
+# レイテンシのヒストグラムのバケット(秒)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# 各メトリクスの説明と種類 (Prometheusの # HELP / # TYPE 行に出力する)
+_DESCRIPTIONS = {
+    "external_request_seconds": ("histogram", "外部API呼び出し1回あたりの所要時間 (レート制限の待機・再試行を含む)"),
+    "external_request_errors_total": ("counter", "失敗した外部API呼び出しの数"),
+    "retries_total": ("counter", "外部API呼び出しの再試行回数"),
+    "rate_limited_total": ("counter", "レート制限(429)を受けた回数"),
+    "rate_limit_wait_seconds": ("histogram", "レート制限のための待機時間"),
+    "bytes_total": ("counter", "外部サービスとの転送量 (バイト)"),
+    "llm_tokens_total": ("counter", "LLMのトークン数"),
+    "llm_cache_hits_total": ("counter", "LLMの応答キャッシュのヒット数"),
+    "sync_phase_seconds": ("histogram", "同期処理の各段階の所要時間"),
+    "sync_messages_total": ("counter", "Notionへの書き込みが完了したメッセージの数"),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+_counters: Dict[str, Dict[LabelKey, float]] = {}
+# ヒストグラム: ラベル → [バケットごとの件数, 合計, 件数]
+_histograms: Dict[str, Dict[LabelKey, list]] = {}
+
+_runner: web.AppRunner | None = None
+
+
+def _key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    """カウンターを増やす"""
+    series = _counters.setdefault(name, {})
+    key = _key(labels)
+    series[key] = series.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels):
+    """ヒストグラムに値を記録する"""
+    series = _histograms.setdefault(name, {})
+    key = _key(labels)
+    if key not in series:
+        series[key] = [[0] * len(DEFAULT_BUCKETS), 0.0, 0]
+    buckets, _, _ = series[key]
+    for i, bound in enumerate(DEFAULT_BUCKETS):
+        if value <= bound:
+            buckets[i] += 1
+    series[key][1] += value
+    series[key][2] += 1
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """ブロックの所要時間をヒストグラムに記録する。例外で抜けた場合はエラーとして数える"""
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        if name == "external_request_seconds":
+            inc("external_request_errors_total", **labels)
+        raise
+    finally:
+        observe(name, time.monotonic() - started, **labels)
+
+
+@contextmanager
+def request_timer(service: str, operation: str) -> Iterator[None]:
+    """外部API呼び出しの所要時間を記録する"""
+    with timer("external_request_seconds", service=service, operation=operation):
+        yield
+
+
+def httpx_event_hooks(service: str) -> dict:
+    """httpxクライアントに渡すイベントフックを返す。送受信のバイト数を記録する
+
+    ストリーミング応答を妨げないよう、受信量は本文を読まずにContent-Lengthから求める。
+    """
+    async def on_request(request):
+        inc("bytes_total", len(request.content or b""), service=service, direction="sent")
+
+    async def on_response(response):
+        inc("bytes_total", int(response.headers.get("content-length", 0)), service=service, direction="received")
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+# --- Prometheus形式の出力 ---
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render() -> str:
+    """全てのメトリクスをPrometheusのテキスト形式で返す"""
+    lines = []
+    for name in sorted(set(_counters) | set(_histograms)):
+        metric_type, description = _DESCRIPTIONS.get(name, ("counter" if name in _counters else "histogram", ""))
+        full_name = PREFIX + name
+        lines.append(f"# HELP {full_name} {description}")
+        lines.append(f"# TYPE {full_name} {metric_type}")
+        for key, value in sorted(_counters.get(name, {}).items()):
+            lines.append(f"{full_name}{_format_labels(key)} {value}")
+        for key, (buckets, total, count) in sorted(_histograms.get(name, {}).items()):
+            for bound, bucket_count in zip(DEFAULT_BUCKETS, buckets):
+                lines.append(f"{full_name}_bucket{_format_labels(key, (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{full_name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+            lines.append(f"{full_name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_http_server():
+    """METRICS_PORTが設定されていれば、/metricsでメトリクスを公開する"""
+    global _runner
+    if not METRICS_PORT or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, int(METRICS_PORT)).start()
+    print(f"メトリクスを http://{METRICS_HOST}:{METRICS_PORT}/metrics で公開しています。")
+
+
+async def stop_http_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+# --- /syncの応答用のまとめ ---
+def snapshot() -> dict:
+    """現時点の値を複製して返す。summarize_sinceで差分を求めるために使う"""
+    return {
+        "counters": {name: dict(series) for name, series in _counters.items()},
+        "histograms": {
+            name: {key: (total, count) for key, (_, total, count) in series.items()}
+            for name, series in _histograms.items()
+        },
+    }
+
+
+def _group_delta(before: dict, name: str, label: str) -> Dict[str, Tuple[float, int]]:
+    """ヒストグラムの(合計, 件数)の差分を、指定したラベルの値ごとに集計する"""
+    grouped: Dict[str, Tuple[float, int]] = {}
+    previous = before["histograms"].get(name, {})
+    for key, (_, total, count) in _histograms.get(name, {}).items():
+        old_total, old_count = previous.get(key, (0.0, 0))
+        if count == old_count:
+            continue
+        group = dict(key).get(label, "")
+        sum_total, sum_count = grouped.get(group, (0.0, 0))
+        grouped[group] = (sum_total + total - old_total, sum_count + count - old_count)
+    return grouped
+
+
+def _counter_delta(before: dict, name: str, label: str) -> Dict[str, float]:
+    grouped: Dict[str, float] = {}
+    previous = before["counters"].get(name, {})
+    for key, value in _counters.get(name, {}).items():
+        delta = value - previous.get(key, 0)
+        if delta:
+            group = dict(key).get(label, "")
+            grouped[group] = grouped.get(group, 0) + delta
+    return grouped
+
+
+def _format_bytes(size: float) -> str:
+    if size < 1024 * 1024:
+        return f"{size / 1024:.0f}KB"
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def summarize_since(before: dict) -> list[str]:
+    """snapshot()の時点からの、段階ごとの所要時間とサービスごとの呼び出し状況を行のリストで返す"""
+    lines = []
+    phases = _group_delta(before, "sync_phase_seconds", "phase")
+    if phases:
+        lines.append("段階別: " + " / ".join(f"{phase} {total:.1f}秒" for phase, (total, _) in phases.items()))
+    retries = _counter_delta(before, "retries_total", "service")
+    rate_limited = _counter_delta(before, "rate_limited_total", "service")
+    transferred = _counter_delta(before, "bytes_total", "service")
+    for service, (total, count) in sorted(_group_delta(before, "external_request_seconds", "service").items()):
+        line = f"{service}: {count}回・平均{total / count:.2f}秒"
+        if retries.get(service):
+            line += f"・再試行{retries[service]:.0f}回"
+        if rate_limited.get(service):
+            line += f"（うちレート制限{rate_limited[service]:.0f}回）"
+        if transferred.get(service):
+            line += f"・転送{_format_bytes(transferred[service])}"
+        lines.append(line)
+    tokens = _counter_delta(before, "llm_tokens_total", "kind")
+    if tokens:
+        lines.append("LLMトークン: " + " / ".join(f"{kind} {count:.0f}" for kind, count in tokens.items()))
+    return lines
@@ -1,17 +1,96 @@
 
+import asyncio
 import os
-from typing import Set, List, Dict, Any
+from datetime import datetime, timezone
+from typing import Set, List, Dict, Any, Tuple
 
-from notion_client import Client
+import httpx
+from notion_client import AsyncClient
+from notion_client.errors import APIErrorCode, APIResponseError, HTTPResponseError, RequestTimeoutError
+
+import local_store
+import metrics
+from rate_limiter import RequestScheduler
+from utils import split_message
 
 # .envから各データベースIDを取得
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
+# 同期対象ごとのデータベースIDを渡さなかった場合に使う既定のデータベース
 FORM_DATABASE_ID = os.getenv("FORM_DATABASE_ID")
 ASSETS_DATABASE_ID = os.getenv("ASSETS_DATABASE_ID")
 DONE_MESSAGES_DATABASE_ID = os.getenv("DONE_MESSAGES_DATABASE_ID")
 
-# Notionクライアントの初期化
-notion = Client(auth=NOTION_API_KEY)
+# 同時に実行するNotion APIリクエストの上限
+NOTION_MAX_CONCURRENCY = int(os.getenv("NOTION_MAX_CONCURRENCY", "4"))
+# Notion APIのレート制限 (インテグレーションあたり平均3リクエスト/秒)
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_RATE_BURST = float(os.getenv("NOTION_RATE_BURST", "3"))
+NOTION_MAX_RETRIES = int(os.getenv("NOTION_MAX_RETRIES", "5"))
+# 取得した子ブロックを再利用する期間(秒)と、保存するブロック数の上限
+NOTION_BLOCK_CACHE_TTL = float(os.getenv("NOTION_BLOCK_CACHE_TTL", "3600"))
+NOTION_BLOCK_CACHE_MAX_ENTRIES = int(os.getenv("NOTION_BLOCK_CACHE_MAX_ENTRIES", "5000"))
+
+# Notionクライアントの初期化 (HTTP接続はプールして使い回す)
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=NOTION_MAX_CONCURRENCY,
+        max_keepalive_connections=NOTION_MAX_CONCURRENCY,
+    ),
+    event_hooks=metrics.httpx_event_hooks("Notion"),
+)
+notion = AsyncClient(auth=NOTION_API_KEY, client=_http_client)
+
+
+def _is_connect_error(error: Exception) -> bool:
+    """接続の確立前に失敗したか (リクエストがNotionに届いていないことが確実か)"""
+    # notion-clientはhttpxのタイムアウトをRequestTimeoutErrorに置き換えるため、元の例外を確認する
+    if isinstance(error, RequestTimeoutError):
+        error = error.__context__
+    return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def _notion_retry_policy(error: Exception, idempotent: bool = True) -> Tuple[bool, float | None]:
+    """Notion APIのエラーが再試行可能かを判定し、Retry-Afterがあれば秒数を返す
+
+    冪等でない書き込み(ページの作成・ブロックの追記)は、レート制限と接続前のエラーだけを再試行する。
+    5xxや読み取りタイムアウトは書き込みが反映済みの場合があり、再試行すると重複するため、
+    アウトボックスの再実行に任せる。
+    """
+    if isinstance(error, APIResponseError) and error.code == APIErrorCode.RateLimited:
+        retry_after = error.headers.get("Retry-After")
+        try:
+            return True, float(retry_after) if retry_after else 1.0
+        except ValueError:
+            return True, 1.0
+    if isinstance(error, HTTPResponseError):
+        return error.status == 429 or (idempotent and error.status >= 500), None
+    if _is_connect_error(error):
+        return True, None
+    if isinstance(error, (RequestTimeoutError, httpx.TransportError)):
+        return idempotent, None
+    return False, None
+
+
+# リレーションを更新中のFormページごとのロック
+_relation_locks: Dict[str, asyncio.Lock] = {}
+
+scheduler = RequestScheduler(
+    "Notion",
+    rate=NOTION_RATE_LIMIT,
+    burst=NOTION_RATE_BURST,
+    max_concurrency=NOTION_MAX_CONCURRENCY,
+    retry_policy=_notion_retry_policy,
+    max_retries=NOTION_MAX_RETRIES,
+)
+
+# blocks.children.append 1回あたりの上限
+MAX_BLOCKS_PER_APPEND = 100
+MAX_RICH_TEXT_LENGTH = 2000
+# 日本語はUTF-8で1文字3バイトになるため、リクエストサイズ上限(500KB)に収まるよう文字数も制限する
+MAX_CHARS_PER_APPEND = 100000
+
+# add_summary_to_pageで追記する要約の見出し (要約対象のテキストからは除外する)
+SUMMARY_HEADING = "🤖 AIによる要約"
 
 
 def _get_text_from_rich_text(rich_text: List[Dict[str, Any]]) -> str:
@@ -19,51 +98,136 @@ def _get_text_from_rich_text(rich_text: List[Dict[str, Any]]) -> str:
     return "".join([t.get("plain_text", "") for t in rich_text])
 
 
-def _get_all_blocks_recursive(block_id: str) -> List[Dict[str, Any]]:
-    """指定されたブロックIDの子ブロックを再帰的にすべて取得する"""
+async def _request(method, idempotent: bool = True, **kwargs) -> Dict[str, Any]:
+    """レート制限と再試行を行うスケジューラを通してNotion APIを呼び出す
+
+    ページの作成やブロックの追記など、再実行すると重複する呼び出しはidempotent=Falseで呼ぶ。
+    """
+    # 例: notion.blocks.children.list → "BlocksChildren.list"
+    operation = f"{type(method.__self__).__name__.removesuffix('Endpoint')}.{method.__name__}"
+    with metrics.request_timer("Notion", operation):
+        return await scheduler.call(method, idempotent=idempotent, **kwargs)
+
+
+async def _list_child_blocks(block_id: str) -> List[Dict[str, Any]]:
+    """指定されたブロックIDの直下の子ブロックを全て取得する"""
     all_blocks = []
     has_more = True
     start_cursor = None
     while has_more:
-        response = notion.blocks.children.list(
+        response = await _request(
+            notion.blocks.children.list,
             block_id=block_id, start_cursor=start_cursor, page_size=100
         )
         blocks = response.get("results", [])
         all_blocks.extend(blocks)
         has_more = response.get("has_more", False)
         start_cursor = response.get("next_cursor")
+    return all_blocks
 
-    for block in all_blocks:
-        if block.get("has_children"):
-            block["children"] = _get_all_blocks_recursive(block["id"])
 
+async def _get_all_blocks_recursive(block_id: str) -> List[Dict[str, Any]]:
+    """指定されたブロックIDの子ブロックを再帰的にすべて取得する"""
+    all_blocks = await _list_child_blocks(block_id)
+    await _fetch_children(all_blocks)
     return all_blocks
 
 
-def get_all_text_from_page(page_id: str) -> str:
+async def _fetch_children(blocks: List[Dict[str, Any]]):
+    """子を持つブロックについて、その子ブロックを再帰的に取得してblock["children"]に格納する。兄弟の部分木は並行して取得する
+
+    前回取得した時から編集されていないブロックは、ローカルに保存した子孫のブロックを使う。
+    """
+    pending = []
+    for block in blocks:
+        if not block.get("has_children"):
+            continue
+        children = None
+        if _is_settled(block):
+            children = local_store.get_block_children(block["id"], block["last_edited_time"], NOTION_BLOCK_CACHE_TTL)
+        if children is None:
+            pending.append(block)
+        else:
+            block["children"] = children
+    await asyncio.gather(*(_fetch_subtree(block) for block in pending))
+
+
+async def _fetch_subtree(block: Dict[str, Any]):
+    # 子ブロックの一覧は取り直し、孫以降はそれぞれのlast_edited_timeで再利用できるかを判定する
+    children = await _list_child_blocks(block["id"])
+    await _fetch_children(children)
+    block["children"] = children
+    if _is_settled(block):
+        local_store.set_block_children(block["id"], block["last_edited_time"], children, NOTION_BLOCK_CACHE_MAX_ENTRIES)
+
+
+def _is_settled(block: Dict[str, Any]) -> bool:
+    """ブロックの最終編集が現在の分より前か
+
+    last_edited_timeは分単位で丸められるため、現在の分に編集されたブロックは
+    この後の同じ分の編集でも値が変わらず、キャッシュの検証に使えない。
+    """
+    last_edited_time = block.get("last_edited_time")
+    if not last_edited_time:
+        return False
+    current_minute = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    return datetime.fromisoformat(last_edited_time.replace("Z", "+00:00")) < current_minute
+
+
+def _extract_text(blocks: List[Dict[str, Any]]) -> str:
+    """ブロックからテキストを抽出して結合する。add_summary_to_pageで追記した要約のセクションは除く"""
+    text_parts = []
+
+    def extract(blocks: List[Dict[str, Any]]):
+        in_summary = False
+        for block in blocks:
+            block_type = block.get("type")
+            if block_type == "heading_2" and _get_text_from_rich_text(block["heading_2"]["rich_text"]) == SUMMARY_HEADING:
+                # 要約の見出しに続く引用ブロックは、AI自身の出力なので読み飛ばす
+                in_summary = True
+                continue
+            if in_summary and block_type in ["quote", "divider"]:
+                continue
+            in_summary = False
+            if block_type in ["paragraph", "heading_1", "heading_2", "heading_3", "bulleted_list_item", "numbered_list_item", "quote", "callout", "toggle"]:
+                text_parts.append(_get_text_from_rich_text(block[block_type]["rich_text"]))
+
+            if block.get("has_children"):
+                extract(block.get("children", []))
+
+    extract(blocks)
+    return "\n".join(text_parts)
+
+
+async def get_all_text_from_page(page_id: str) -> str:
     """ページの全ブロックからテキストを抽出し、一つの文字列として結合して返す"""
+    text, _, _ = await get_page_text_since(page_id)
+    return text
+
+
+async def get_page_text_since(page_id: str, after_block_id: str | None = None) -> Tuple[str, str | None, bool]:
+    """
+    after_block_idより後に追加されたブロックのテキストを返す。
+    戻り値は (テキスト, ページ末尾のブロックID, 差分のみを取得できたか)。
+    after_block_idが見つからない場合(未指定・削除済み)は、ページ全体のテキストを返す。
+    """
     try:
-        all_blocks = _get_all_blocks_recursive(page_id)
-        text_parts = []
-
-        def extract_text(blocks: List[Dict[str, Any]]):
-            for block in blocks:
-                block_type = block.get("type")
-                if block_type in ["paragraph", "heading_1", "heading_2", "heading_3", "bulleted_list_item", "numbered_list_item", "quote", "callout", "toggle"]:
-                    text_parts.append(_get_text_from_rich_text(block[block_type]["rich_text"]))
-                
-                if block.get("has_children"):
-                    extract_text(block.get("children", []))
-
-        extract_text(all_blocks)
-        print(f"ページID {page_id} からテキストの抽出が完了しました。")
-        return "\n".join(text_parts)
+        top_blocks = await _list_child_blocks(page_id)
+        block_ids = [block["id"] for block in top_blocks]
+        is_incremental = after_block_id is not None and after_block_id in block_ids
+        if is_incremental:
+            top_blocks = top_blocks[block_ids.index(after_block_id) + 1:]
+        # 子ブロックは対象のブロックについてのみ取得する
+        await _fetch_children(top_blocks)
+        text = _extract_text(top_blocks)
+        print(f"ページID {page_id} からテキストの抽出が完了しました。" + (" (前回の要約以降の差分)" if is_incremental else ""))
+        return text, block_ids[-1] if block_ids else None, is_incremental
     except Exception as e:
         print(f"ページ {page_id} からのテキスト抽出中にエラー: {e}")
-        return ""
+        return "", None, False
 
 
-def add_summary_to_page(page_id: str, summary_text: str):
+async def add_summary_to_page(page_id: str, summary_text: str) -> bool:
     """指定されたページの末尾に、AIによる要約を見出し付きで追記する"""
     try:
         # 2000文字ごとにチャンクに分割（Notionのブロック上限を考慮）
@@ -84,7 +248,7 @@ def add_summary_to_page(page_id: str, summary_text: str):
                             {
                                 "type": "text", 
                                 "text": {
-                                    "content": "🤖 AIによる要約"
+                                    "content": SUMMARY_HEADING
                                 }
                             }
                         ]
@@ -92,22 +256,32 @@ def add_summary_to_page(page_id: str, summary_text: str):
             },
             *quote_blocks
         ]
-        notion.blocks.children.append(block_id=page_id, children=blocks_to_append)
+        await _request(notion.blocks.children.append, idempotent=False, block_id=page_id, children=blocks_to_append)
         print(f"ページ {page_id} にAIによる要約を追記しました。")
+        local_store.index_summary(page_id, summary_text)
+        return True
     except Exception as e:
         print(f"ページ {page_id} への要約追記中にエラー: {e}")
+        return False
 
 
-def query_done_message_ids() -> Set[str]:
+async def query_done_message_ids(since: str | None = None, database_id: str | None = None) -> Set[str]:
+    """処理済みメッセージIDを取得する。sinceを指定した場合はそれ以降に編集された行のみを取得する"""
     processed_ids = set()
     has_more = True
     start_cursor = None
+    query_filter = None
+    if since:
+        query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}}
     while has_more:
-        response = notion.databases.query(
-            database_id=DONE_MESSAGES_DATABASE_ID,
-            start_cursor=start_cursor,
-            page_size=100,
-        )
+        query_args = {
+            "database_id": database_id or DONE_MESSAGES_DATABASE_ID,
+            "start_cursor": start_cursor,
+            "page_size": 100,
+        }
+        if query_filter:
+            query_args["filter"] = query_filter
+        response = await _request(notion.databases.query, **query_args)
         for page in response.get("results", []):
             title_list = page.get("properties", {}).get("メッセージID", {}).get("title", [])
             if title_list:
@@ -119,10 +293,44 @@ def query_done_message_ids() -> Set[str]:
     print(f"Notionから{len(processed_ids)}件の処理済みメッセージIDを取得しました。")
     return processed_ids
 
-def query_form_page_by_thread_id(thread_id: str) -> str | None:
+async def query_form_pages(since: str | None = None, database_id: str | None = None) -> Dict[str, str]:
+    """Formデータベースを一巡し、スレッドID → ページIDの対応を返す。sinceを指定した場合はそれ以降に編集されたページのみ"""
+    form_pages = {}
+    has_more = True
+    start_cursor = None
+    while has_more:
+        query_args = {
+            "database_id": database_id or FORM_DATABASE_ID,
+            "start_cursor": start_cursor,
+            "page_size": 100,
+        }
+        if since:
+            query_args["filter"] = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}}
+        response = await _request(notion.databases.query, **query_args)
+        for page in response.get("results", []):
+            rich_text = page.get("properties", {}).get("スレッドID", {}).get("rich_text", [])
+            thread_id = _get_text_from_rich_text(rich_text)
+            if thread_id:
+                form_pages[thread_id] = page["id"]
+        has_more = response.get("has_more", False)
+        start_cursor = response.get("next_cursor")
+    print(f"Notionから{len(form_pages)}件のFormページを取得しました。")
+    return form_pages
+
+async def is_page_archived(page_id: str) -> bool:
+    """ページがアーカイブ（ゴミ箱に移動）されているかを確認する"""
+    try:
+        page = await _request(notion.pages.retrieve, page_id=page_id)
+        return bool(page.get("archived") or page.get("in_trash"))
+    except Exception as e:
+        print(f"ページ {page_id} の状態確認中にエラー: {e}")
+        return False
+
+async def query_form_page_by_thread_id(thread_id: str, database_id: str | None = None) -> str | None:
     try:
-        response = notion.databases.query(
-            database_id=FORM_DATABASE_ID,
+        response = await _request(
+            notion.databases.query,
+            database_id=database_id or FORM_DATABASE_ID,
             filter={"property": "スレッドID", "rich_text": {"equals": thread_id}},
         )
         results = response.get("results", [])
@@ -133,8 +341,33 @@ def query_form_page_by_thread_id(thread_id: str) -> str | None:
         print(f"スレッドIDでのページ検索中にエラー: {e}")
         return None
 
-def create_form_page(
-    thread_name: str, thread_id: str, first_message_content: str, post_date: str, author_name: str
+def _paragraph_block(text: str) -> Dict[str, Any]:
+    return {
+        "object": "block",
+        "type": "paragraph",
+        "paragraph": {"rich_text": [{"type": "text", "text": {"content": text}}]}
+    }
+
+def _content_blocks(content: str) -> List[Dict[str, Any]]:
+    """本文をリッチテキストの文字数上限ごとに段落ブロックへ分割する"""
+    return [_paragraph_block(chunk) for chunk in split_message(content, MAX_RICH_TEXT_LENGTH)]
+
+def build_message_blocks(content: str, author_name: str, post_time: str) -> List[Dict[str, Any]]:
+    """1メッセージ分のブロック（ヘッダー + 本文）を組み立てる"""
+    header_text = f"--- {post_time} | {author_name} ---"
+    return [_paragraph_block(header_text), *_content_blocks(content)]
+
+def blocks_text_length(blocks: List[Dict[str, Any]]) -> int:
+    """ブロックに含まれるテキストの合計文字数を返す"""
+    return sum(
+        len(t["text"]["content"])
+        for block in blocks
+        for t in block.get(block["type"], {}).get("rich_text", [])
+    )
+
+async def create_form_page(
+    thread_name: str, thread_id: str, first_message_content: str, post_date: str, author_name: str,
+    database_id: str | None = None,
 ) -> str | None:
     try:
         properties = {
@@ -143,16 +376,10 @@ def create_form_page(
             "投稿日時": {"date": {"start": post_date}},
             "投稿者": {"rich_text": [{"text": {"content": author_name}}]}
         }
-        children = [
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {"rich_text": [{"type": "text", "text": {"content": first_message_content}}]
-                              }
-            }
-        ]
-        response = notion.pages.create(
-            parent={"database_id": FORM_DATABASE_ID},
+        children = _content_blocks(first_message_content)
+        response = await _request(
+            notion.pages.create, idempotent=False,
+            parent={"database_id": database_id or FORM_DATABASE_ID},
             properties=properties,
             children=children
         )
@@ -161,42 +388,37 @@ def create_form_page(
         print(f"Formページの新規作成中にエラー: {e}")
         return None
 
-def append_text_to_page(page_id: str, content: str, author_name: str, post_time: str):
+async def append_blocks_to_page(page_id: str, blocks: List[Dict[str, Any]]) -> bool:
+    """ブロックをまとめてページ末尾に追記する。呼び出し側で上限内に収めておくこと"""
     try:
-        header_text = f"--- {post_time} | {author_name} ---"
-        blocks = [
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {"rich_text": [{"type": "text", "text": {"content": header_text}}]}
-            }
-            ,
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {"rich_text": [{"type": "text", "text": {"content": content}}]}
-            }
-            
-        ]
-        notion.blocks.children.append(block_id=page_id, children=blocks)
+        await _request(notion.blocks.children.append, idempotent=False, block_id=page_id, children=blocks)
+        return True
     except Exception as e:
         print(f"ページ {page_id} へのブロック追記中にエラー: {e}")
+        return False
+
+async def append_text_to_page(page_id: str, content: str, author_name: str, post_time: str) -> bool:
+    return await append_blocks_to_page(page_id, build_message_blocks(content, author_name, post_time))
 
-def add_done_message(message_id: str, form_page_id: str):
+async def add_done_message(message_id: str, form_page_id: str, database_id: str | None = None) -> str | None:
     try:
         properties = {
             "メッセージID": {"title": [{"text": {"content": message_id}}],},
             "関連スレッド": {"relation": [{"id": form_page_id}]}
         }
-        notion.pages.create(
-            parent={"database_id": DONE_MESSAGES_DATABASE_ID},
+        response = await _request(
+            notion.pages.create, idempotent=False,
+            parent={"database_id": database_id or DONE_MESSAGES_DATABASE_ID},
             properties=properties
         )
+        return response["id"]
     except Exception as e:
         print(f"DoneMessageの記録中にエラー: {e}")
+        return None
 
-def create_asset_page(
-    file_name: str, file_url: str, file_type: str, file_size: int, post_date: str
+async def create_asset_page(
+    file_name: str, file_url: str, file_type: str, file_size: int, post_date: str,
+    database_id: str | None = None,
 ) -> str | None:
     try:
         properties = {
@@ -206,8 +428,9 @@ def create_asset_page(
             "ファイルサイズ": {"number": file_size},
             "投稿日時": {"date": {"start": post_date}}
         }
-        response = notion.pages.create(
-            parent={"database_id": ASSETS_DATABASE_ID},
+        response = await _request(
+            notion.pages.create, idempotent=False,
+            parent={"database_id": database_id or ASSETS_DATABASE_ID},
             properties=properties
         )
         return response["id"]
@@ -215,15 +438,46 @@ def create_asset_page(
         print(f"Assetページの作成中にエラー: {e}")
         return None
 
-def relate_asset_to_form(form_page_id: str, asset_page_ids: list):
+async def _get_relation_ids(page_id: str, property_name: str) -> List[str]:
+    """ページのリレーションプロパティに設定済みのページIDを全て取得する"""
+    page = await _request(notion.pages.retrieve, page_id=page_id)
+    prop = page.get("properties", {}).get(property_name, {})
+    relation_ids = [r["id"] for r in prop.get("relation", [])]
+    if not prop.get("has_more"):
+        return relation_ids
+
+    # 25件を超えるリレーションはプロパティ単位のAPIでページングして取得する
+    relation_ids = []
+    has_more = True
+    start_cursor = None
+    while has_more:
+        query_args = {"page_id": page_id, "property_id": prop["id"]}
+        if start_cursor:
+            query_args["start_cursor"] = start_cursor
+        response = await _request(notion.pages.properties.retrieve, **query_args)
+        relation_ids.extend(item["relation"]["id"] for item in response.get("results", []))
+        has_more = response.get("has_more", False)
+        start_cursor = response.get("next_cursor")
+    return relation_ids
+
+
+async def relate_asset_to_form(form_page_id: str, asset_page_ids: list) -> bool:
+    """FormページにAssetページを関連付ける。既存の関連付けは残したまま追加する"""
     if not asset_page_ids:
-        return
-    try:
-        notion.pages.update(
-            page_id=form_page_id,
-            properties={
-                "関連アセット": {"relation": [{"id": page_id} for page_id in asset_page_ids]}
-            }
-        )
-    except Exception as e:
-        print(f"FormとAssetのリレーション設定中にエラー: {e}")
+        return True
+    # 同じページへの読み取り→更新が並行すると追加分が失われるため、ページごとに直列化する
+    async with _relation_locks.setdefault(form_page_id, asyncio.Lock()):
+        try:
+            relation_ids = await _get_relation_ids(form_page_id, "関連アセット")
+            relation_ids.extend(page_id for page_id in asset_page_ids if page_id not in relation_ids)
+            await _request(
+                notion.pages.update,
+                page_id=form_page_id,
+                properties={
+                    "関連アセット": {"relation": [{"id": page_id} for page_id in relation_ids]}
+                }
+            )
+            return True
+        except Exception as e:
+            print(f"FormとAssetのリレーション設定中にエラー: {e}")
+            return False
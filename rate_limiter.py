@@ -0,0 +1,231 @@
+import asyncio
+import contextvars
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Tuple
+
+import metrics
+
+# 例外と、呼び出しが冪等か(再実行しても結果が重複しないか)を受け取り、
+# (再試行するか, サーバー指定の待機秒数 or None) を返す関数
+RetryPolicy = Callable[[Exception, bool], Tuple[bool, float | None]]
+
+# 待ち行列を公平に分け合う単位 (同期対象の名前など)。呼び出し元のタスクで設定すると、そこから作られたタスクにも引き継がれる
+fair_share_key: contextvars.ContextVar[str | None] = contextvars.ContextVar("fair_share_key", default=None)
+
+
+class FairQueue:
+    """キーごとの待ち行列から、キーを順番に巡って1つずつ取り出す (ラウンドロビン)
+
+    1つのキーが大量に積んでも、他のキーの待ちが後回しにされ続けることはない。
+    """
+
+    def __init__(self):
+        self._queues: Dict[str | None, Deque[asyncio.Future]] = {}
+        self._order: Deque[str | None] = deque()
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def push(self, key: str | None, future: asyncio.Future):
+        if key not in self._queues:
+            self._queues[key] = deque()
+            self._order.append(key)
+        self._queues[key].append(future)
+
+    def pop(self) -> asyncio.Future | None:
+        """次に順番が来た待ちを取り出す。キャンセル済みの待ちは読み飛ばす"""
+        while self._order:
+            key = self._order.popleft()
+            queue = self._queues[key]
+            future = queue.popleft()
+            if queue:
+                self._order.append(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                return future
+        return None
+
+
+class TokenBucket:
+    """一定レートでトークンを補充し、呼び出しのペースを制御するトークンバケット
+
+    トークンはfair_share_keyごとに順番に配るため、複数の同期対象が同じレート制限を公平に分け合う。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = FairQueue()
+        self._dispatcher: asyncio.Task | None = None
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Retry-Afterなどで指定された時間、全ての呼び出しを止める"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self) -> float:
+        """トークンを1つ取得する。待機した秒数を返す"""
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.push(fair_share_key.get(), future)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        return time.monotonic() - started
+
+    async def _dispatch(self):
+        """トークンが補充されるたびに、待ち行列の順番に従って配る"""
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._paused_until - now
+            if wait <= 0:
+                if self._tokens >= 1:
+                    future = self._waiters.pop()
+                    if future is not None:
+                        self._tokens -= 1
+                        future.set_result(None)
+                    continue
+                wait = (1 - self._tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class FairSemaphore:
+    """同時実行数の枠を、空いた順にfair_share_keyごとに順番に割り当てるセマフォ"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = FairQueue()
+
+    async def __aenter__(self):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return self
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.push(fair_share_key.get(), future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 枠を受け取った直後にキャンセルされた場合は、次の待ちに譲る
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        # 待っている呼び出しがあれば、枠をそのまま次の順番に引き渡す
+        future = self._waiters.pop()
+        if future is not None:
+            future.set_result(None)
+        else:
+            self._value += 1
+
+
+class RequestScheduler:
+    """トークンバケットによるペース制御・同時実行数の制限・ジッター付き再試行をまとめて行う"""
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        max_concurrency: int,
+        retry_policy: RetryPolicy,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.retry_policy = retry_policy
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = FairSemaphore(max_concurrency)
+        self._in_flight = 0
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def _backoff(self, attempt: int) -> float:
+        # フルジッター: 0 〜 base * 2^attempt の一様乱数
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, idempotent: bool = True, **kwargs) -> Any:
+        """funcをレート制限の範囲内で実行し、再試行可能なエラーであればバックオフして再実行する
+
+        idempotent=Falseの呼び出し(作成・追記など)は、サーバーに届いた可能性のあるエラーを再試行するかを
+        retry_policyに判断させる。
+        """
+        attempt = 0
+        while True:
+            waited = await self.bucket.acquire()
+            self._stats["total_wait_seconds"] += waited
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+            metrics.observe("rate_limit_wait_seconds", waited, service=self.name)
+            async with self._semaphore:
+                self._in_flight += 1
+                self._stats["requests"] += 1
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    last_error = e
+                    retryable, retry_after = self.retry_policy(e, idempotent)
+                    if not retryable or attempt >= self.max_retries:
+                        self._stats["failures"] += 1
+                        raise
+                finally:
+                    self._in_flight -= 1
+
+            attempt += 1
+            self._stats["retries"] += 1
+            metrics.inc("retries_total", service=self.name)
+            if retry_after is not None:
+                # サーバーから待機時間が指定された場合は、全ての呼び出しをその間止める
+                self._stats["rate_limited"] += 1
+                metrics.inc("rate_limited_total", service=self.name)
+                self.bucket.pause(retry_after)
+                delay = retry_after + random.uniform(0, self.base_delay)
+            else:
+                delay = self._backoff(attempt)
+            print(f"[{self.name}] リクエストを{delay:.1f}秒後に再試行します ({attempt}/{self.max_retries}): {last_error}")
+            await asyncio.sleep(delay)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """キューの深さや待機時間などの統計を返す"""
+        return {
+            **self._stats,
+            "queue_depth": self.bucket.waiting,
+            "in_flight": self._in_flight,
+        }
+
+    def format_stats(self) -> str:
+        stats = self.get_stats()
+        return (
+            f"[{self.name}] リクエスト{stats['requests']}回 / 再試行{stats['retries']}回"
+            f" (うちレート制限{stats['rate_limited']}回) / 失敗{stats['failures']}回"
+            f" / 待機時間 合計{stats['total_wait_seconds']:.1f}秒・最大{stats['max_wait_seconds']:.1f}秒"
+            f" / 待ち行列{stats['queue_depth']}件"
+        )
@@ -0,0 +1,57 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SyncCoordinator:
+    """同期処理を同時に1つだけ実行させ、実行中に来た呼び出しは実行中の結果を待たせる"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._task: asyncio.Task | None = None
+        self._reset_progress()
+
+    def _reset_progress(self):
+        self.started_at: float | None = None
+        self.phase = "待機中"
+        self.total = 0
+        self.processed = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def run(self, func: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """同期が実行中でなければfuncを開始し、実行中であればその完了を待って同じ結果を返す"""
+        if not self.is_running:
+            self._reset_progress()
+            self.started_at = time.monotonic()
+            self._task = asyncio.create_task(func())
+        else:
+            print(f"[{self.name}] 実行中の同期に合流します。")
+        # 呼び出し元がキャンセルされても、実行中の同期自体は止めない
+        return await asyncio.shield(self._task)
+
+    # --- 進捗の報告 (同期処理の中から呼び出す) ---
+    def set_phase(self, phase: str):
+        self.phase = phase
+
+    def add_total(self, count: int):
+        self.total += count
+
+    def advance(self, count: int = 1):
+        if self.is_running:
+            self.processed += count
+
+    def describe(self) -> str:
+        """進捗と残り時間の目安を文字列で返す"""
+        if not self.is_running:
+            return "同期は実行されていません。"
+        elapsed = time.monotonic() - self.started_at
+        text = f"{self.phase} (経過{elapsed:.0f}秒"
+        if self.total:
+            text += f"、{self.processed}/{self.total}件"
+            if self.processed:
+                remaining = elapsed / self.processed * (self.total - self.processed)
+                text += f"、残り約{remaining:.0f}秒"
+        return text + ")"
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+from typing import Any, Dict, List
+
+from sync_coordinator import SyncCoordinator
+
+# 同期対象(Discordチャンネル → Notionデータベース)の一覧を書いたJSONファイル
+# 未設定の場合は、従来の環境変数(TARGET_CHANNEL_IDなど)から同期対象を1つだけ作る
+SYNC_TARGETS_FILE = os.getenv("SYNC_TARGETS_FILE")
+# 同期対象ごとに、スレッドの履歴取得とNotionへの書き込みを並行して行う数の既定値
+# (discord.pyがレート制限バケットごとに待機するため、控えめにする)
+DEFAULT_WORKERS = int(os.getenv("DISCORD_FETCH_CONCURRENCY", "4"))
+# 定時同期の既定のスケジュール (APSchedulerのCronTriggerに渡す引数)
+DEFAULT_SCHEDULE = {"hour": "12,0", "minute": "0", "second": "0"}
+# 設定ファイルで省略できる項目と、その既定値に使う環境変数
+_ENV_DEFAULTS = {
+    "form_database_id": "FORM_DATABASE_ID",
+    "assets_database_id": "ASSETS_DATABASE_ID",
+    "done_messages_database_id": "DONE_MESSAGES_DATABASE_ID",
+    "drive_folder_id": "GOOGLE_DRIVE_FOLDER_ID",
+}
+
+
+class SyncTarget:
+    """1つのDiscordチャンネルと、その書き込み先のNotionデータベース・Driveフォルダの対応
+
+    同期の実行状態(単一実行の制御・書き込みの排他・同時実行枠)は同期対象ごとに持ち、
+    ある同期対象の同期が長引いても、他の同期対象の同期は待たされない。
+    """
+
+    def __init__(
+        self, name: str, channel_id: int,
+        form_database_id: str, assets_database_id: str, done_messages_database_id: str,
+        drive_folder_id: str | None = None, schedule: Dict[str, Any] | None = None, workers: int = DEFAULT_WORKERS,
+    ):
+        self.name = name
+        self.channel_id = int(channel_id)
+        self.form_database_id = form_database_id
+        self.assets_database_id = assets_database_id
+        self.done_messages_database_id = done_messages_database_id
+        self.drive_folder_id = drive_folder_id
+        self.schedule = schedule or DEFAULT_SCHEDULE
+        self.workers = max(1, int(workers))
+        # 定時同期と/syncコマンドの同期を1つにまとめる
+        self.coordinator = SyncCoordinator(f"Discord→Notion同期: {name}")
+        # 定時同期とリアルタイム同期が同じメッセージを同時に書き込まないための排他
+        self.write_lock = asyncio.Lock()
+        # スレッドの履歴取得・書き込みの同時実行枠
+        self.worker_semaphore = asyncio.Semaphore(self.workers)
+
+    def __repr__(self) -> str:
+        return f"SyncTarget({self.name!r}, channel_id={self.channel_id})"
+
+
+def _target_from_entry(entry: Dict[str, Any]) -> SyncTarget:
+    options = {key: entry.get(key, os.getenv(env_name)) for key, env_name in _ENV_DEFAULTS.items()}
+    missing = [key for key in ("name", "channel_id") if key not in entry]
+    missing += [key for key, value in options.items() if key != "drive_folder_id" and not value]
+    if missing:
+        raise ValueError(f"同期対象の設定に必要な項目がありません: {entry.get('name', entry)} ({', '.join(missing)})")
+    return SyncTarget(
+        name=entry["name"], channel_id=entry["channel_id"], **options,
+        schedule=entry.get("schedule"), workers=entry.get("workers", DEFAULT_WORKERS),
+    )
+
+
+def load_sync_targets() -> List[SyncTarget]:
+    """同期対象の一覧を読み込む"""
+    if not SYNC_TARGETS_FILE:
+        return [_target_from_entry({"name": "default", "channel_id": int(os.getenv("TARGET_CHANNEL_ID"))})]
+
+    with open(SYNC_TARGETS_FILE, encoding="utf-8") as f:
+        entries = json.load(f)
+    targets = [_target_from_entry(entry) for entry in entries]
+    for attribute in ("name", "channel_id"):
+        values = [getattr(target, attribute) for target in targets]
+        duplicates = {value for value in values if values.count(value) > 1}
+        if duplicates:
+            raise ValueError(f"同期対象の{attribute}が重複しています: {', '.join(map(str, duplicates))}")
+    if not targets:
+        raise ValueError(f"同期対象が1つも設定されていません: {SYNC_TARGETS_FILE}")
+    print(f"{len(targets)}件の同期対象を読み込みました: {', '.join(target.name for target in targets)}")
+    return targets
+
+
+SYNC_TARGETS = load_sync_targets()
+# アウトボックスの操作に同期対象が記録されていない場合(設定を複数にする前の記録)に使う同期対象
+DEFAULT_TARGET = SYNC_TARGETS[0]
+
+
+def get_target(name: str) -> SyncTarget | None:
+    return next((target for target in SYNC_TARGETS if target.name == name), None)
+
+
+def find_target_by_channel(channel_id: int | None) -> SyncTarget | None:
+    """チャンネルID(スレッドの場合は親チャンネルのID)から同期対象を探す"""
+    return next((target for target in SYNC_TARGETS if target.channel_id == channel_id), None)